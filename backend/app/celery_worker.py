@@ -1,15 +1,58 @@
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_init
+from sqlalchemy import insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from app.config import settings
-from app.database import SessionLocal
+from app.database import SessionLocal, engine
+from app.redis_client import redis_client
 from app.services.trivy_service import trivy_service
 from app.models import SBOM, ScanResult, Vulnerability, ScanVulnerability
+import ciso8601
 import logging
+import orjson
+import os
 import time
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# geventプールで起動された場合(celeryは-P geventならアプリ読み込み前に
+# monkey patchを適用する)、psycopg2もコオペレーティブにする。
+# psycopg2はC拡張(libpq)でmonkey patchの対象外のため、これが無いと
+# DB呼び出しのたびにハブごとブロックして全グリーンレットが直列化する
+try:
+    from gevent import monkey
+    if monkey.is_module_patched('socket'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        logger.info("psycopg2 patched for gevent cooperative waits")
+except ImportError:
+    pass
+
+
+def _parse_iso_date(value):
+    """
+    ISO 8601形式の日時文字列をdatetimeに変換
+
+    ciso8601はC実装で末尾'Z'をそのまま処理できるため、
+    行ごとのstr.replace + fromisoformatより大幅に速い
+    """
+    if not value:
+        return None
+    try:
+        return ciso8601.parse_datetime(value)
+    except ValueError:
+        logger.warning(f"Invalid ISO date: {value}")
+        return None
+
+# CVE一括INSERTの1ステートメントあたりの行数
+CVE_INSERT_CHUNK_SIZE = 500
+
+# Trivy DBを新しいとみなす秒数(11時間 — 12時間のbeat間隔より少し短く)
+TRIVY_DB_FRESH_SECONDS = 39600
+TRIVY_DB_LAST_UPDATE_KEY = "trivy_db_last_update"
+
 # Celeryアプリケーションの作成
 celery_app = Celery(
     "sbom_scanner",
@@ -30,23 +73,105 @@ celery_app.conf.update(
     worker_max_tasks_per_child=1000,
 )
 
+# タスクルーティング設定
+# スキャン/DB更新はTrivyサブプロセスとDB待ちが大半のI/Oバウンドなタスクなので
+# geventプール(-P gevent -c 50)の"io"キューで高並列に処理する
+celery_app.conf.task_routes = {
+    'app.celery_worker.scan_sbom': {'queue': 'io'},
+    'app.celery_worker.update_trivy_db': {'queue': 'io'},
+}
+
 # Celery Beat スケジュール設定
 celery_app.conf.beat_schedule = {
     'update-trivy-database-every-12-hours': {
         'task': 'app.celery_worker.update_trivy_db',
         'schedule': crontab(hour='*/12', minute=0),  # 12時間ごと
     },
+    'db-connection-health-check-every-5-minutes': {
+        'task': 'app.celery_worker.db_health_check',
+        'schedule': crontab(minute='*/5'),  # 5分ごと
+    },
 }
 
 
+@worker_process_init.connect
+def init_worker_db_pool(**kwargs):
+    """
+    ワーカープロセス起動時にDBエンジンを再初期化する
+
+    親プロセスから継承したソケットを子プロセスで共有すると
+    接続が壊れるため、プールを破棄して各プロセス専用に作り直す
+    """
+    engine.dispose()
+
+
+@celery_app.task(name='app.celery_worker.db_health_check')
+def db_health_check():
+    """
+    接続プールのヘルスチェックタスク
+    定期的にSELECT 1を発行してスタール接続を早期に検出・再接続する
+    """
+    db = SessionLocal()
+    try:
+        db.execute(text("SELECT 1"))
+        return {"status": "healthy"}
+    except Exception as e:
+        logger.error(f"DB health check failed: {str(e)}")
+        engine.dispose()
+        return {"status": "unhealthy", "error": str(e)}
+    finally:
+        db.close()
+
+
 @celery_app.task(name='app.celery_worker.update_trivy_db')
-def update_trivy_db():
+def update_trivy_db(force: bool = False):
     """
     Trivy脆弱性データベースを更新するタスク
     12時間ごとに実行される
+
+    DBが新しい場合はサブプロセスを起動せずスキップする
+    (判定はRedisの更新記録、なければmetadata.jsonのmtimeを参照)
+
+    Args:
+        force: Trueの場合は鮮度チェックをスキップして必ず更新する
     """
     logger.info("Starting Trivy database update task...")
-    
+
+    if not force:
+        try:
+            last_update = redis_client.get(TRIVY_DB_LAST_UPDATE_KEY)
+        except Exception as e:
+            logger.warning(f"Failed to read Trivy DB update state from Redis: {str(e)}")
+            last_update = None
+
+        if last_update:
+            logger.info(f"Trivy DB is fresh (last update: {last_update}), skipping")
+            return {
+                "status": "skipped",
+                "reason": "database is fresh",
+                "last_update": last_update,
+                "timestamp": datetime.utcnow().isoformat()
+            }
+
+        # Redisに記録がなければローカルDBのmetadata.jsonで実際の鮮度を確認
+        db_age = trivy_service.get_db_age_seconds()
+        if db_age is not None and db_age < TRIVY_DB_FRESH_SECONDS:
+            try:
+                redis_client.setex(
+                    TRIVY_DB_LAST_UPDATE_KEY,
+                    int(TRIVY_DB_FRESH_SECONDS - db_age),
+                    datetime.utcnow().isoformat()
+                )
+            except Exception:
+                pass
+            logger.info(f"Trivy DB is fresh (age: {int(db_age)}s), skipping")
+            return {
+                "status": "skipped",
+                "reason": "database is fresh",
+                "db_age_seconds": int(db_age),
+                "timestamp": datetime.utcnow().isoformat()
+            }
+
     try:
         # Trivyのインストール確認
         if not trivy_service.check_trivy_installed():
@@ -60,7 +185,18 @@ def update_trivy_db():
         
         # Trivy DBを更新
         stats = trivy_service.update_database()
-        
+
+        # 更新成功を記録(11時間以内の再実行はスキップされる)
+        if stats.get("status") == "success":
+            try:
+                redis_client.setex(
+                    TRIVY_DB_LAST_UPDATE_KEY,
+                    TRIVY_DB_FRESH_SECONDS,
+                    datetime.utcnow().isoformat()
+                )
+            except Exception as e:
+                logger.warning(f"Failed to record Trivy DB update in Redis: {str(e)}")
+
         logger.info(f"Trivy DB update completed: {stats}")
         return {
             "status": "success",
@@ -89,7 +225,8 @@ def scan_sbom(self, sbom_id: str):  # UUIDを文字列として受け取る
     
     logger.info(f"Starting Trivy SBOM scan task for SBOM ID: {sbom_id}")
     db = SessionLocal()
-    
+    scan_lock_key = None
+
     try:
         # UUIDに変換
         try:
@@ -110,15 +247,38 @@ def scan_sbom(self, sbom_id: str):  # UUIDを文字列として受け取る
                 "error": "SBOM not found"
             }
         
+        # アップロード側が取得した重複スキャン防止ロックのキー(finallyで解放)
+        scan_lock_key = f"scan:lock:{sbom.file_hash}"
+
         # スキャン開始時刻
         start_time = time.time()
         
         logger.info(f"Scanning SBOM: {sbom.filename} (format: {sbom.format})")
-        
+
+        # SBOMをバイト列のまま取得してTrivyへ渡す
+        # (JSONB→dict→JSON再シリアライズの往復を回避するゼロコピー経路)
+        sbom_raw = None
+        if sbom.content_uri and sbom.content_uri.endswith('.json') \
+                and os.path.exists(sbom.content_uri):
+            # アップロード原本がuploadsボリュームにあればそれを読む
+            try:
+                with open(sbom.content_uri, 'rb') as f:
+                    sbom_raw = f.read()
+            except OSError as e:
+                logger.warning(f"Failed to read stored SBOM {sbom.content_uri}: {str(e)}")
+        if sbom_raw is None:
+            # JSONBをPython dictに変換せずテキストとして直接取り出す
+            raw_text = db.execute(
+                text("SELECT content_json::text FROM sboms WHERE id = :id"),
+                {"id": sbom_uuid}
+            ).scalar()
+            if raw_text:
+                sbom_raw = raw_text.encode('utf-8')
+
         # Trivyでスキャン実行
         scan_results = trivy_service.scan_sbom(
-            sbom_content=sbom.content_json,
-            sbom_format=sbom.format
+            sbom_format=sbom.format,
+            sbom_raw=sbom_raw
         )
         
         if scan_results.get("status") != "success":
@@ -127,76 +287,129 @@ def scan_sbom(self, sbom_id: str):  # UUIDを文字列として受け取る
         # スキャン所要時間を計算
         scan_duration = int(time.time() - start_time)
         
-        # コンポーネント数を計算(フォーマットに応じて異なるキーを使用)
-        if sbom.format.lower() == 'cyclonedx':
-            total_components = len(sbom.content_json.get('components', []))
-        elif sbom.format.lower() == 'spdx':
-            total_components = len(sbom.content_json.get('packages', []))
-        else:
-            # 両方試す
-            components = sbom.content_json.get('components', [])
-            packages = sbom.content_json.get('packages', [])
-            total_components = len(components) if components else len(packages)
+        # コンポーネント数はアップロード時に計算済みの値を使う
+        total_components = sbom.component_count
+        if total_components is None:
+            # 旧データ向けフォールバック(フォーマットに応じて異なるキーを使用)
+            sbom_content = orjson.loads(sbom_raw) if sbom_raw else (sbom.content_json or {})
+            if sbom.format.lower() == 'cyclonedx':
+                total_components = len(sbom_content.get('components', []))
+            elif sbom.format.lower() == 'spdx':
+                total_components = len(sbom_content.get('packages', []))
+            else:
+                # 両方試す
+                components = sbom_content.get('components', [])
+                packages = sbom_content.get('packages', [])
+                total_components = len(components) if components else len(packages)
         
         logger.info(f"Total components in SBOM: {total_components}")
         
         # スキャン結果をデータベースに保存
-        scan_result = ScanResult(
-            sbom_id=sbom_uuid,  # UUIDを使用
-            scan_date=datetime.utcnow(),
-            status='completed',
-            total_components=total_components,
-            vulnerable_count=scan_results['vulnerable_components_count'],
-            critical_count=scan_results['severity_counts'].get('CRITICAL', 0),
-            high_count=scan_results['severity_counts'].get('HIGH', 0),
-            medium_count=scan_results['severity_counts'].get('MEDIUM', 0),
-            low_count=scan_results['severity_counts'].get('LOW', 0),
-            scan_duration_seconds=scan_duration
-        )
-        
-        db.add(scan_result)
-        db.flush()  # IDを取得
+        # Core INSERT + RETURNINGでIDを取得(unit-of-workのflushを介さない)
+        scan_result_id = db.execute(
+            insert(ScanResult).values(
+                sbom_id=sbom_uuid,  # UUIDを使用
+                scan_date=datetime.utcnow(),
+                status='completed',
+                total_components=total_components,
+                vulnerable_count=scan_results['vulnerable_components_count'],
+                critical_count=scan_results['severity_counts'].get('CRITICAL', 0),
+                high_count=scan_results['severity_counts'].get('HIGH', 0),
+                medium_count=scan_results['severity_counts'].get('MEDIUM', 0),
+                low_count=scan_results['severity_counts'].get('LOW', 0),
+                scan_duration_seconds=scan_duration
+            ).returning(ScanResult.id)
+        ).scalar_one()
         
         # 脆弱性の詳細を保存
+        # 既存CVEのIDを1回のSELECTでまとめて取得(脆弱性ごとのSELECTを回避)
+        cve_ids = {v['cve_id'] for v in scan_results['vulnerabilities']}
+        cve_id_map = dict(db.execute(
+            select(Vulnerability.cve_id, Vulnerability.id)
+            .where(Vulnerability.cve_id.in_(cve_ids))
+        ).all()) if cve_ids else {}
+
+        # 未登録のCVEを一括INSERT (競合時はスキップしてIDを回収)
+        new_vuln_rows = []
+        seen_new_cves = set()
         for vuln_data in scan_results['vulnerabilities']:
-            # Vulnerabilityテーブルに保存または取得
-            vulnerability = db.query(Vulnerability).filter(
-                Vulnerability.cve_id == vuln_data['cve_id']
-            ).first()
-            
-            if not vulnerability:
-                vulnerability = Vulnerability(
-                    cve_id=vuln_data['cve_id'],
-                    severity=vuln_data['severity'],
-                    description=vuln_data.get('description', ''),
-                    cvss_score=vuln_data.get('cvss_score', 0.0),
-                    cvss_vector=vuln_data.get('cvss_vector', ''),
-                    published_date=datetime.fromisoformat(vuln_data['published_date'].replace('Z', '+00:00')) if vuln_data.get('published_date') else None,
-                    modified_date=datetime.fromisoformat(vuln_data['last_modified_date'].replace('Z', '+00:00')) if vuln_data.get('last_modified_date') else None,
-                    references={'urls': vuln_data.get('references', [])}
-                )
-                db.add(vulnerability)
-                db.flush()
-            
-            # ScanVulnerabilityに関連付け
-            scan_vuln = ScanVulnerability(
-                scan_result_id=scan_result.id,
-                vulnerability_id=vulnerability.id,
-                component_name=vuln_data['component_name'],
-                component_version=vuln_data['component_version'],
-                matched_cpe=vuln_data.get('target', '')
-            )
-            db.add(scan_vuln)
-        
+            cve_id = vuln_data['cve_id']
+            if cve_id in cve_id_map or cve_id in seen_new_cves:
+                continue
+            seen_new_cves.add(cve_id)
+            new_vuln_rows.append({
+                "cve_id": cve_id,
+                "severity": vuln_data['severity'],
+                "description": vuln_data.get('description', ''),
+                "cvss_score": vuln_data.get('cvss_score', 0.0),
+                "cvss_vector": vuln_data.get('cvss_vector', ''),
+                "published_date": _parse_iso_date(vuln_data.get('published_date')),
+                "modified_date": _parse_iso_date(vuln_data.get('last_modified_date')),
+                "references": {'urls': vuln_data.get('references', [])}
+            })
+
+        if new_vuln_rows:
+            # cve_id順に整列してからチャンク単位でINSERTする
+            # 並行スキャン同士がユニークインデックス(cve_id)のロックを
+            # 同じ順序で取得するため、デッドロックと競合待ちが減る
+            new_vuln_rows.sort(key=lambda row: row['cve_id'])
+            for i in range(0, len(new_vuln_rows), CVE_INSERT_CHUNK_SIZE):
+                chunk = new_vuln_rows[i:i + CVE_INSERT_CHUNK_SIZE]
+                inserted = db.execute(
+                    pg_insert(Vulnerability)
+                    .on_conflict_do_nothing(index_elements=['cve_id'])
+                    .returning(Vulnerability.cve_id, Vulnerability.id),
+                    chunk
+                ).all()
+                cve_id_map.update(dict(inserted))
+
+            # 並行スキャンに先を越されてRETURNINGに含まれなかったCVEを補完
+            missing = seen_new_cves - cve_id_map.keys()
+            if missing:
+                cve_id_map.update(dict(db.execute(
+                    select(Vulnerability.cve_id, Vulnerability.id)
+                    .where(Vulnerability.cve_id.in_(missing))
+                ).all()))
+
+        # ScanVulnerabilityの行を収集(後で一括INSERT)
+        scan_vuln_rows = []
+        for vuln_data in scan_results['vulnerabilities']:
+            vulnerability_id = cve_id_map.get(vuln_data['cve_id'])
+            if vulnerability_id is None:
+                logger.warning(f"Vulnerability ID not resolved for {vuln_data['cve_id']}")
+                continue
+            scan_vuln_rows.append({
+                "scan_result_id": scan_result_id,
+                "vulnerability_id": vulnerability_id,
+                "component_name": vuln_data['component_name'],
+                "component_version": vuln_data['component_version'],
+                # targetはターゲット横断で重複排除されたリスト(カラムは255文字)
+                "matched_cpe": ", ".join(vuln_data.get('target') or [])[:255]
+            })
+
+        # 1回の複数行INSERTで関連付けを保存(行ごとのadd/flushを回避)
+        if scan_vuln_rows:
+            db.execute(insert(ScanVulnerability), scan_vuln_rows)
+
         db.commit()
-        
-        logger.info(f"Trivy scan completed for SBOM ID: {sbom_id}, Result ID: {scan_result.id}")
+
+        # 新しいスキャン結果がコミットされたのでAPI側のレスポンスキャッシュを無効化
+        try:
+            redis_client.delete(
+                f"scan:result:{sbom_id}",
+                f"scan:summary:{sbom_id}",
+                f"scan:export:{sbom_id}:json"
+            )
+        except Exception as e:
+            logger.warning(f"Failed to invalidate scan cache for SBOM {sbom_id}: {str(e)}")
+
+        logger.info(f"Trivy scan completed for SBOM ID: {sbom_id}, Result ID: {scan_result_id}")
         logger.info(f"Found {len(scan_results['vulnerabilities'])} vulnerabilities")
         
         return {
             "status": "success",
             "sbom_id": sbom_id,
-            "scan_result_id": scan_result.id,
+            "scan_result_id": scan_result_id,
             "total_components": total_components,
             "vulnerable_count": scan_results['vulnerable_components_count'],
             "total_vulnerabilities": scan_results['total_vulnerabilities'],
@@ -228,6 +441,12 @@ def scan_sbom(self, sbom_id: str):  # UUIDを文字列として受け取る
         }
         
     finally:
+        # 重複スキャン防止ロックを解放
+        if scan_lock_key:
+            try:
+                redis_client.delete(scan_lock_key)
+            except Exception as e:
+                logger.warning(f"Failed to release scan lock {scan_lock_key}: {str(e)}")
         db.close()
 
 
@@ -4,11 +4,22 @@ from sqlalchemy.orm import sessionmaker
 from app.config import settings
 
 # データベースエンジンの作成
+#
+# 接続数の予算: pool_size * uvicornワーカー数 + 10 がPostgresの
+# max_connections(デフォルト100)に収まること。ワーカーを増やす場合は
+# PgBouncer(transactionモード)を前段に置いてpool_sizeを5程度に下げる
 engine = create_engine(
     settings.DATABASE_URL,
     pool_pre_ping=True,
-    pool_size=10,
-    max_overflow=20
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_recycle=3600,  # 古い接続を1時間で再接続しスタール接続エラーを防ぐ
+    # psycopg2のexecutemanyを複数行VALUES文にまとめる
+    # (スキャン結果やCVEの一括INSERTが1行1文ではなくバッチで送られる)
+    executemany_mode="values_plus_batch",
+    insertmanyvalues_page_size=1000,
+    executemany_batch_page_size=500
 )
 
 # セッションの作成
@@ -1,9 +1,11 @@
 from fastapi import FastAPI, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from app.config import settings
 from app.database import init_db
 from app.routers import api_router
+from app.services.trivy_service import trivy_service
+import asyncio
 import logging
 
 # ロギング設定
@@ -19,7 +21,8 @@ app = FastAPI(
     description="SBOM脆弱性診断システム",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse  # 大きなスキャン結果のシリアライズを高速化
 )
 
 # CORS設定
@@ -38,6 +41,9 @@ async def startup_event():
     logger.info("Starting SBOM Vulnerability Checker API...")
     init_db()
     logger.info("Database initialized")
+    # スキャンは--skip-db-updateで走るため、起動時にDBの鮮度を保証する
+    # (未取得/24h超過の場合のみダウンロード。ブロッキングなのでスレッドへ)
+    await asyncio.to_thread(trivy_service.ensure_db_fresh)
 
 
 @app.on_event("shutdown")
@@ -100,5 +106,7 @@ if __name__ == "__main__":
         host=settings.BACKEND_HOST,
         port=settings.BACKEND_PORT,
         reload=settings.DEBUG,
-        workers=1 if settings.DEBUG else settings.BACKEND_WORKERS
+        workers=None if settings.DEBUG else settings.BACKEND_WORKERS,
+        loop="uvloop",       # Linuxではlibuvベースのイベントループで2-4倍のスループット
+        http="httptools"     # HTTPパースをC実装にオフロード
     )
@@ -1,6 +1,7 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Text, DECIMAL, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Text, DECIMAL, JSON, Index, ForeignKey, text
 from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.orm import deferred, relationship
 from app.database import Base
 import uuid
 
@@ -8,13 +9,20 @@ import uuid
 class SBOM(Base):
     """SBOMモデル"""
     __tablename__ = "sboms"
-    
+
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     filename = Column(String(255), nullable=False)
     format = Column(String(50), nullable=False)  # 'cyclonedx' or 'spdx'
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     file_hash = Column(String(64), unique=True, nullable=False, index=True)
-    content_json = Column(JSONB, nullable=False)
+    # コンポーネント数はアップロード時に計算して保持
+    # (一覧・重複チェックでcontent_jsonを再パースしないため)
+    component_count = Column(Integer, default=0)
+    # アップロード原本の保存先パス(共有uploadsボリューム上、file_hashベース)
+    # スキャン時はJSONBを経由せずこのファイルを直接読む
+    content_uri = Column(String(512))
+    # 最大50MBのJSONBは明示的にアクセスされるまでロードしない
+    content_json = deferred(Column(JSONB, nullable=False))
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -37,12 +45,33 @@ class Vulnerability(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+class VulnerabilityProduct(Base):
+    """CPE製品名の非正規化モデル
+
+    cpe_matchのcriteriaから抽出した(製品名, ベンダー名)を行持ちし、
+    スキャン時の候補絞り込みをJSONBの線形走査ではなく
+    インデックス付きのSQL検索で行えるようにする
+    """
+    __tablename__ = "vulnerability_products"
+
+    id = Column(Integer, primary_key=True, index=True)
+    vulnerability_id = Column(Integer, ForeignKey('vulnerabilities.id', ondelete='CASCADE'), nullable=False, index=True)
+    product = Column(String(255), nullable=False, index=True)
+    vendor = Column(String(255))
+
+
 class ScanResult(Base):
     """スキャン結果モデル"""
     __tablename__ = "scan_results"
-    
+
+    # 最新スキャン取得(WHERE sbom_id = ? ORDER BY scan_date DESC LIMIT 1)を
+    # 1回のインデックス探索で解決するための複合インデックス
+    __table_args__ = (
+        Index('ix_scan_results_sbom_scandate', 'sbom_id', text('scan_date DESC')),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
-    sbom_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+    sbom_id = Column(UUID(as_uuid=True), ForeignKey('sboms.id', ondelete='CASCADE'), nullable=False, index=True)
     scan_date = Column(DateTime, default=datetime.utcnow, index=True)
     status = Column(String(50))  # 'completed', 'in_progress', 'failed'
     total_components = Column(Integer, default=0)
@@ -54,15 +83,42 @@ class ScanResult(Base):
     scan_duration_seconds = Column(Integer)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    # 検出された脆弱性(lazy="raise"で暗黙のN+1ロードを禁止 —
+    # 利用側はselectinload等で明示的にロードする)
+    vulnerabilities = relationship(
+        "ScanVulnerability", back_populates="scan_result", lazy="raise",
+        passive_deletes=True
+    )
+
 
 class ScanVulnerability(Base):
     """スキャン脆弱性関連モデル"""
     __tablename__ = "scan_vulnerabilities"
-    
+
+    # スキャン結果単位の詳細取得(WHERE scan_result_id = ?)を
+    # インデックスオンリースキャンにするカバリングインデックス
+    __table_args__ = (
+        Index(
+            'ix_scan_vulnerabilities_scan_result_covering',
+            'scan_result_id',
+            postgresql_include=['vulnerability_id', 'component_name', 'component_version']
+        ),
+    )
+
+
     id = Column(Integer, primary_key=True, index=True)
-    scan_result_id = Column(Integer, nullable=False, index=True)
-    vulnerability_id = Column(Integer, nullable=False, index=True)
+    scan_result_id = Column(Integer, ForeignKey('scan_results.id', ondelete='CASCADE'), nullable=False, index=True)
+    vulnerability_id = Column(Integer, ForeignKey('vulnerabilities.id'), nullable=False, index=True)
     component_name = Column(String(255), nullable=False)
     component_version = Column(String(100))
     matched_cpe = Column(String(255))
     created_at = Column(DateTime, default=datetime.utcnow)
+
+    scan_result = relationship(
+        "ScanResult", back_populates="vulnerabilities", lazy="raise"
+    )
+    # lazy="joined"だとScanVulnerabilityを選ぶ全クエリに別名のLEFT OUTER
+    # JOINが暗黙に付く(明示JOINするクエリでは同じ行を二重に取得する)。
+    # ScanResult.vulnerabilitiesと同じくlazy="raise"にして、必要な側が
+    # joinedload等で明示的にロードする
+    vulnerability = relationship("Vulnerability", lazy="raise")
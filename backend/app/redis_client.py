@@ -0,0 +1,5 @@
+import redis
+from app.config import settings
+
+# アプリ全体で共有するRedisクライアント(コネクションプール内蔵)
+redis_client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
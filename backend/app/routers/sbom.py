@@ -1,11 +1,16 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
+from sqlalchemy import select, delete
 from sqlalchemy.orm import Session
 from app.database import get_db
 from app.models import SBOM, ScanResult
+from app.redis_client import redis_client
 from app.services.sbom_parser import SBOMParser, SBOMParserException
 from app.celery_worker import scan_sbom
+from app.config import settings
 import hashlib
 import logging
+import orjson
+import os
 from datetime import datetime
 from uuid import UUID
 
@@ -22,26 +27,37 @@ async def upload_sbom_file(
     SBOMファイルをアップロードします
     """
     try:
-        # ファイルサイズチェック (50MB)
-        contents = await file.read()
-        if len(contents) > 52428800:
-            raise HTTPException(
-                status_code=400,
-                detail={"code": "FILE_TOO_LARGE", "message": "ファイルサイズが50MBを超えています"}
-            )
-        
         # ファイル形式チェック
         if not file.filename.endswith(('.json', '.xml')):
             raise HTTPException(
                 status_code=400,
                 detail={"code": "INVALID_FILE_FORMAT", "message": "サポートされていないファイル形式です"}
             )
+
+        # 1MBずつストリーム読み込みしながらハッシュを逐次計算
+        # (50MBを一括で読み込む前にサイズ超過を検出できる)
+        hasher = hashlib.sha256()
+        buf = bytearray()
+        total_size = 0
+        while chunk := await file.read(1 << 20):
+            total_size += len(chunk)
+            if total_size > 52428800:  # 50MB
+                raise HTTPException(
+                    status_code=400,
+                    detail={"code": "FILE_TOO_LARGE", "message": "ファイルサイズが50MBを超えています"}
+                )
+            hasher.update(chunk)
+            buf.extend(chunk)
+
+        contents = bytes(buf)
+        file_hash = hasher.hexdigest()
         
-        # ファイルハッシュの計算
-        file_hash = hashlib.sha256(contents).hexdigest()
-        
-        # 重複チェック
-        existing = db.query(SBOM).filter(SBOM.file_hash == file_hash).first()
+        # 重複チェック(存在確認に必要なカラムのみ取得し、JSONBを読まない)
+        existing = db.execute(
+            select(SBOM.id, SBOM.filename, SBOM.format,
+                   SBOM.uploaded_at, SBOM.component_count)
+            .where(SBOM.file_hash == file_hash)
+        ).first()
         if existing:
             logger.info(f"Duplicate SBOM detected: ID={existing.id}, filename={existing.filename}")
             
@@ -51,20 +67,28 @@ async def upload_sbom_file(
                 .order_by(ScanResult.scan_date.desc())\
                 .first()
             
-            # 再スキャンを実行
-            scan_task = scan_sbom.delay(str(existing.id))  # UUIDを文字列として渡す
-            logger.info(f"Rescan task started: task_id={scan_task.id}, sbom_id={existing.id}")
+            # 同一ハッシュのスキャンが実行中ならタスクを重複起動しない
+            # (CIからの連続アップロードによるTrivy多重実行を防ぐ)
+            lock_key = f"scan:lock:{file_hash}"
+            if redis_client.set(lock_key, "pending", nx=True, ex=300):
+                scan_task = scan_sbom.delay(str(existing.id))  # UUIDを文字列として渡す
+                redis_client.set(lock_key, scan_task.id, ex=300)
+                scan_task_id = scan_task.id
+                logger.info(f"Rescan task started: task_id={scan_task_id}, sbom_id={existing.id}")
+            else:
+                scan_task_id = redis_client.get(lock_key)
+                logger.info(f"Rescan already in flight: task_id={scan_task_id}, sbom_id={existing.id}")
             
             # 既存のSBOM情報を返す
             response_data = {
                 "sbom_id": str(existing.id),  # UUIDを文字列に変換
                 "filename": existing.filename,
                 "format": existing.format,
-                "file_hash": existing.file_hash,
+                "file_hash": file_hash,
                 "uploaded_at": existing.uploaded_at.isoformat(),
-                "component_count": len(existing.content_json.get('components', [])),
+                "component_count": existing.component_count or 0,
                 "scan_status": "rescanning",
-                "scan_task_id": scan_task.id,
+                "scan_task_id": scan_task_id,
                 "is_duplicate": True,
                 "previous_scan": {
                     "scan_id": latest_scan.id,
@@ -92,12 +116,28 @@ async def upload_sbom_file(
                 detail={"code": "PARSE_ERROR", "message": str(e)}
             )
         
+        # アップロード原本をfile_hashキーでuploadsボリュームに保存
+        # (スキャン時にJSONBをデシリアライズせず原本を直接使える)
+        content_uri = None
+        try:
+            os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+            ext = '.xml' if file.filename.endswith('.xml') else '.json'
+            content_uri = os.path.join(settings.UPLOAD_DIR, f"{file_hash}{ext}")
+            with open(content_uri, 'wb') as f:
+                f.write(contents)
+        except OSError as e:
+            logger.warning(f"Failed to store SBOM content file: {str(e)}")
+            content_uri = None
+
         # データベースに保存
         sbom = SBOM(
             filename=file.filename,
             format=parsed_data['format'],
             file_hash=file_hash,
-            content_json=parsed_data['raw_data'],
+            component_count=len(parsed_data.get('components', [])),
+            # パーサーはraw_dataを保持しないため、JSONBカラムには原本から直接変換する
+            content_json=orjson.loads(contents) if file.filename.endswith('.json') else {},
+            content_uri=content_uri,
             uploaded_at=datetime.utcnow()
         )
         
@@ -152,27 +192,34 @@ async def get_sboms(
     """
     try:
         offset = (page - 1) * limit
-        
+
         # 総件数を取得
         total = db.query(SBOM).count()
-        
-        # データを取得
-        sboms = db.query(SBOM).order_by(SBOM.uploaded_at.desc()).offset(offset).limit(limit).all()
-        
+
+        # SBOMごとの最新スキャン結果をDISTINCT ONで1クエリにまとめる
+        # (SBOMごとの個別SELECTによるN+1を回避)
+        latest = select(ScanResult)\
+            .distinct(ScanResult.sbom_id)\
+            .order_by(ScanResult.sbom_id, ScanResult.scan_date.desc())\
+            .subquery()
+
+        # 必要なカラムのみ取得(JSONB content_jsonを転送しない)
+        rows = db.query(
+                SBOM.id, SBOM.filename, SBOM.format, SBOM.uploaded_at,
+                latest.c.status, latest.c.vulnerable_count)\
+            .outerjoin(latest, latest.c.sbom_id == SBOM.id)\
+            .order_by(SBOM.uploaded_at.desc())\
+            .offset(offset).limit(limit).all()
+
         items = []
-        for sbom in sboms:
-            # 最新のスキャン結果を取得
-            latest_scan = db.query(ScanResult).filter(
-                ScanResult.sbom_id == sbom.id
-            ).order_by(ScanResult.scan_date.desc()).first()
-            
+        for sbom_id, filename, sbom_format, uploaded_at, scan_status, vulnerable_count in rows:
             items.append({
-                "id": str(sbom.id),  # UUIDを文字列に変換
-                "file_name": sbom.filename,
-                "file_format": sbom.format,
-                "uploaded_at": sbom.uploaded_at.isoformat(),
-                "scan_status": latest_scan.status if latest_scan else "not_scanned",
-                "vulnerable_count": latest_scan.vulnerable_count if latest_scan else 0
+                "id": str(sbom_id),  # UUIDを文字列に変換
+                "file_name": filename,
+                "file_format": sbom_format,
+                "uploaded_at": uploaded_at.isoformat(),
+                "scan_status": scan_status if scan_status else "not_scanned",
+                "vulnerable_count": vulnerable_count if vulnerable_count else 0
             })
         
         return {
@@ -258,18 +305,33 @@ async def delete_sbom(
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid SBOM ID format")
         
-        sbom = db.query(SBOM).filter(SBOM.id == sbom_uuid).first()
-        
-        if not sbom:
+        # 1回のDELETEで削除し、スキャン結果・脆弱性関連はDBのCASCADEに任せる
+        # (RETURNINGで原本ファイルのパスを同じ往復で回収する)
+        deleted = db.execute(
+            delete(SBOM)
+            .where(SBOM.id == sbom_uuid)
+            .returning(SBOM.content_uri)
+        ).first()
+
+        if deleted is None:
+            db.rollback()
             raise HTTPException(status_code=404, detail="SBOM not found")
-        
-        # 関連するスキャン結果も削除
-        db.query(ScanResult).filter(ScanResult.sbom_id == sbom_uuid).delete()
-        
-        # SBOMを削除
-        db.delete(sbom)
+
         db.commit()
-        
+
+        # uploadsボリュームに保存した原本も削除する(ベストエフォート —
+        # 行は消えているので失敗してもレスポンスは成功のまま)
+        content_uri = deleted[0]
+        if content_uri:
+            try:
+                os.unlink(content_uri)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(
+                    f"Failed to remove SBOM content file {content_uri}: {str(e)}"
+                )
+
         logger.info(f"SBOM deleted: ID={sbom_id}")
         
         return {
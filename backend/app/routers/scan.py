@@ -1,82 +1,174 @@
 """Scan Result Router"""
-from fastapi import APIRouter, HTTPException, Depends, Query
-from fastapi.responses import Response
-from sqlalchemy.orm import Session
-from app.database import get_db
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import select, func, cast, Float
+from sqlalchemy.orm import Session, raiseload
+from app.database import get_db, SessionLocal
 from app.models import ScanResult, ScanVulnerability, Vulnerability
+from app.redis_client import redis_client
 from app.services.report_service import report_service
+import hashlib
+import orjson
 import logging
+from typing import Literal
 from uuid import UUID
 
 router = APIRouter(prefix="/api/v1/scan", tags=["Scan"])
 logger = logging.getLogger(__name__)
 
+# スキャン結果は再スキャンまで不変なのでRedisにキャッシュする
+# (celery_worker.scan_sbomがコミット後に該当キーを削除して無効化)
+SCAN_CACHE_TTL_SECONDS = 300
+
+
+def _cache_get(key: str):
+    """Redisキャッシュから取得(Redis障害時はDBへフォールバック)"""
+    try:
+        return redis_client.get(key)
+    except Exception as e:
+        logger.warning(f"Redis cache read failed for {key}: {str(e)}")
+        return None
+
+
+def _cache_set(key: str, value: str):
+    """RedisキャッシュにTTL付きで保存(失敗しても処理は続行)"""
+    try:
+        redis_client.setex(key, SCAN_CACHE_TTL_SECONDS, value)
+    except Exception as e:
+        logger.warning(f"Redis cache write failed for {key}: {str(e)}")
+
+
+def _latest_scan_etag(db: Session, sbom_uuid: UUID):
+    """
+    最新スキャンのETagを計算
+
+    (id, scan_date)だけの軽いSELECT 1回で済むので、本体の再構築前の
+    304判定に使える。スキャン結果が無い場合は(None, None)
+
+    Returns:
+        (scan_result_id, etag文字列)のタプル
+    """
+    row = db.execute(
+        select(ScanResult.id, ScanResult.scan_date)
+        .where(ScanResult.sbom_id == sbom_uuid)
+        .order_by(ScanResult.scan_date.desc())
+        .limit(1)
+    ).first()
+    if row is None:
+        return None, None
+    etag = hashlib.blake2b(
+        f"{row.id}:{row.scan_date.timestamp()}".encode(),
+        digest_size=16
+    ).hexdigest()
+    return row.id, etag
+
+
+def _get_latest_scan(db: Session, sbom_uuid: UUID) -> ScanResult:
+    """
+    最新のスキャン結果(ヘッダ行のみ)を取得
+
+    raiseload('*')をガードとして併用し、明示的にロードしていない
+    リレーションへのアクセスは即座に例外にする。新しいルーターでも
+    このパターン(明示ローダー + raiseload('*'))を踏襲すること。
+    脆弱性リストは_fetch_vulnerability_rowsで別途取得する
+    """
+    return db.query(ScanResult).options(
+        raiseload('*')
+    ).filter(
+        ScanResult.sbom_id == sbom_uuid
+    ).order_by(ScanResult.scan_date.desc()).first()
+
+
+# _fetch_vulnerability_rowsが返す行のキー(SELECT句の並びと一致させること)
+_VULN_ROW_KEYS = (
+    "cve_id", "severity", "cvss_score", "cvss_vector", "description",
+    "component_name", "component_version", "published_date", "references"
+)
+
+
+def _fetch_vulnerability_rows(db: Session, scan_result_id: int) -> list:
+    """
+    スキャン結果に紐づく脆弱性のレスポンス用辞書リストを構築
+
+    ORMオブジェクトを経由せずカラムだけを射影したRowタプルを受け取り、
+    日付整形(to_char)とDECIMAL→float変換もDB側で済ませる。
+    行あたりのPython処理はタプル→dict変換1回だけになる
+    """
+    stmt = select(
+        Vulnerability.cve_id,
+        Vulnerability.severity,
+        cast(Vulnerability.cvss_score, Float),
+        Vulnerability.cvss_vector,
+        Vulnerability.description,
+        ScanVulnerability.component_name,
+        ScanVulnerability.component_version,
+        func.to_char(
+            Vulnerability.published_date, 'YYYY-MM-DD"T"HH24:MI:SS'
+        ),
+        Vulnerability.references
+    ).join_from(
+        ScanVulnerability,
+        Vulnerability,
+        ScanVulnerability.vulnerability_id == Vulnerability.id
+    ).where(ScanVulnerability.scan_result_id == scan_result_id)
+
+    return [dict(zip(_VULN_ROW_KEYS, row)) for row in db.execute(stmt)]
+
 
 @router.get("/{sbom_id}/result")
-async def get_scan_result(
-    sbom_id: str,  # UUIDを文字列として受け取る
+def get_scan_result(
+    sbom_id: UUID,  # パスパラメータの時点でUUIDとして検証される
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     """
     指定されたSBOMの最新スキャン結果を取得
     """
     try:
-        # UUIDに変換
-        try:
-            sbom_uuid = UUID(sbom_id)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid SBOM ID format")
-        
-        # 最新のスキャン結果を取得
-        scan_result = db.query(ScanResult).filter(
-            ScanResult.sbom_id == sbom_uuid
-        ).order_by(ScanResult.scan_date.desc()).first()
-        
+        # 軽量SELECTでETagを計算し、クライアントが最新なら304で打ち切る
+        _, etag = _latest_scan_etag(db, sbom_id)
+        if etag is None:
+            raise HTTPException(status_code=404, detail="Scan result not found")
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+
+        # キャッシュヒットなら本体クエリを打たずに返す
+        cache_key = f"scan:result:{sbom_id}"
+        cached = _cache_get(cache_key)
+        if cached:
+            return {"success": True, "data": orjson.loads(cached)}
+
+        # 最新のスキャン結果を取得し、脆弱性はカラム射影で一括取得
+        scan_result = _get_latest_scan(db, sbom_id)
+
         if not scan_result:
             raise HTTPException(status_code=404, detail="Scan result not found")
-        
-        # スキャンで検出された脆弱性の詳細を取得
-        scan_vulnerabilities = db.query(ScanVulnerability, Vulnerability).join(
-            Vulnerability,
-            ScanVulnerability.vulnerability_id == Vulnerability.id
-        ).filter(
-            ScanVulnerability.scan_result_id == scan_result.id
-        ).all()
-        
-        vulnerabilities = []
-        for scan_vuln, vuln in scan_vulnerabilities:
-            vulnerabilities.append({
-                "cve_id": vuln.cve_id,
-                "severity": vuln.severity,
-                "cvss_score": float(vuln.cvss_score) if vuln.cvss_score else None,
-                "cvss_vector": vuln.cvss_vector,
-                "description": vuln.description,
-                "component_name": scan_vuln.component_name,
-                "component_version": scan_vuln.component_version,
-                "published_date": vuln.published_date.isoformat() if vuln.published_date else None,
-                "references": vuln.references
-            })
-        
-        return {
-            "success": True,
-            "data": {
-                "scan_id": scan_result.id,
-                "sbom_id": str(scan_result.sbom_id),  # UUIDを文字列に変換
-                "scan_date": scan_result.scan_date.isoformat(),
-                "status": scan_result.status,
-                "total_components": scan_result.total_components,
-                "vulnerable_count": scan_result.vulnerable_count,
-                "severity_counts": {
-                    "critical": scan_result.critical_count,
-                    "high": scan_result.high_count,
-                    "medium": scan_result.medium_count,
-                    "low": scan_result.low_count
-                },
-                "scan_duration_seconds": scan_result.scan_duration_seconds,
-                "vulnerabilities": vulnerabilities
-            }
+
+        vulnerabilities = _fetch_vulnerability_rows(db, scan_result.id)
+
+        data = {
+            "scan_id": scan_result.id,
+            "sbom_id": str(scan_result.sbom_id),  # UUIDを文字列に変換
+            "scan_date": scan_result.scan_date.isoformat(),
+            "status": scan_result.status,
+            "total_components": scan_result.total_components,
+            "vulnerable_count": scan_result.vulnerable_count,
+            "severity_counts": {
+                "critical": scan_result.critical_count,
+                "high": scan_result.high_count,
+                "medium": scan_result.medium_count,
+                "low": scan_result.low_count
+            },
+            "scan_duration_seconds": scan_result.scan_duration_seconds,
+            "vulnerabilities": vulnerabilities
         }
-        
+
+        _cache_set(cache_key, orjson.dumps(data).decode())
+
+        return {"success": True, "data": data}
+
     except HTTPException:
         raise
     except Exception as e:
@@ -85,7 +177,7 @@ async def get_scan_result(
 
 
 @router.get("/history")
-async def get_scan_history(
+def get_scan_history(
     page: int = 1,
     limit: int = 20,
     db: Session = Depends(get_db)
@@ -95,15 +187,23 @@ async def get_scan_history(
     """
     try:
         offset = (page - 1) * limit
-        
-        # 総件数
-        total = db.query(ScanResult).count()
-        
-        # スキャン結果を取得
-        scan_results = db.query(ScanResult).order_by(
-            ScanResult.scan_date.desc()
-        ).offset(offset).limit(limit).all()
-        
+
+        # ページ取得と総件数をウィンドウ関数で1クエリにまとめる
+        # (COUNT(*)とページSELECTの2往復を1往復に削減)
+        stmt = select(
+            ScanResult,
+            func.count().over().label("total")
+        ).order_by(ScanResult.scan_date.desc()).offset(offset).limit(limit)
+        rows = db.execute(stmt).all()
+
+        if rows:
+            total = rows[0].total
+            scan_results = [row.ScanResult for row in rows]
+        else:
+            # ページ範囲外(または0件)の場合のみ件数を別クエリで取得
+            total = db.execute(select(func.count()).select_from(ScanResult)).scalar()
+            scan_results = []
+
         items = []
         for scan in scan_results:
             items.append({
@@ -140,8 +240,8 @@ async def get_scan_history(
 
 
 @router.post("/{sbom_id}/rescan")
-async def rescan_sbom(
-    sbom_id: str,  # UUIDを文字列として受け取る
+def rescan_sbom(
+    sbom_id: UUID,  # パスパラメータの時点でUUIDとして検証される
     db: Session = Depends(get_db)
 ):
     """
@@ -150,20 +250,14 @@ async def rescan_sbom(
     try:
         from app.celery_worker import scan_sbom
         from app.models import SBOM
-        
-        # UUIDに変換
-        try:
-            sbom_uuid = UUID(sbom_id)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid SBOM ID format")
-        
+
         # SBOMの存在確認
-        sbom = db.query(SBOM).filter(SBOM.id == sbom_uuid).first()
+        sbom = db.query(SBOM).filter(SBOM.id == sbom_id).first()
         if not sbom:
             raise HTTPException(status_code=404, detail="SBOM not found")
-        
+
         # スキャンタスクを起動 (文字列UUIDを渡す)
-        scan_task = scan_sbom.delay(sbom_id)
+        scan_task = scan_sbom.delay(str(sbom_id))
         
         logger.info(f"Rescan task started: task_id={scan_task.id}, sbom_id={sbom_id}")
         
@@ -184,56 +278,124 @@ async def rescan_sbom(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# CSVストリーミング時にまとめてyieldする行数
+CSV_STREAM_CHUNK_ROWS = 500
+
+
+def _iter_csv_report(scan_result_id: int, summary_data: dict):
+    """
+    CSVレポートを行単位で生成するジェネレータ
+
+    ヘッダー/行レイアウト/サマリーブロックの定義は
+    report_service.iter_csv_reportに一本化し、ここでは
+    サーバーサイドカーソル(yield_per)から行dictを供給するだけにする。
+    全脆弱性をリストに積まないためピークメモリはO(チャンク)。
+    レスポンス送信中もセッションが必要なので、Dependsのセッションとは
+    別に自前で開いてクローズする
+    """
+    db = SessionLocal()
+    try:
+        stmt = select(ScanVulnerability, Vulnerability).join(
+            Vulnerability,
+            ScanVulnerability.vulnerability_id == Vulnerability.id
+        ).where(
+            ScanVulnerability.scan_result_id == scan_result_id
+        ).execution_options(yield_per=CSV_STREAM_CHUNK_ROWS)
+
+        def iter_rows():
+            for scan_vuln, vuln in db.execute(stmt):
+                yield {
+                    "cve_id": vuln.cve_id,
+                    "severity": vuln.severity or "",
+                    "cvss_score": float(vuln.cvss_score) if vuln.cvss_score else "",
+                    "component_name": scan_vuln.component_name,
+                    "component_version": scan_vuln.component_version or "",
+                    "description": vuln.description or "",
+                    "published_date": vuln.published_date.isoformat() if vuln.published_date else "",
+                    "cvss_vector": vuln.cvss_vector or ""
+                }
+
+        yield from report_service.iter_csv_report({
+            **summary_data,
+            "vulnerabilities": iter_rows()
+        })
+    finally:
+        db.close()
+
+
 @router.get("/{sbom_id}/export")
-async def export_scan_report(
-    sbom_id: str,  # UUIDを文字列として受け取る
-    format: str = Query("json", regex="^(json|csv)$"),
+def export_scan_report(
+    sbom_id: UUID,  # パスパラメータの時点でUUIDとして検証される
+    request: Request,
+    format: Literal["json", "csv"] = Query("json"),
     db: Session = Depends(get_db)
 ):
     """
     スキャン結果をエクスポート
-    
+
     Args:
         sbom_id: SBOM ID (UUID)
         format: エクスポート形式 (json or csv)
     """
     try:
-        # UUIDに変換
-        try:
-            sbom_uuid = UUID(sbom_id)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid SBOM ID format")
-        
-        # 最新のスキャン結果を取得
-        scan_result = db.query(ScanResult).filter(
-            ScanResult.sbom_id == sbom_uuid
-        ).order_by(ScanResult.scan_date.desc()).first()
-        
+        # クライアントが最新のレポートを持っていればレポート再生成を省略
+        _, etag = _latest_scan_etag(db, sbom_id)
+        if etag is None:
+            raise HTTPException(status_code=404, detail="Scan result not found")
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        if format == "csv":
+            # CSVはジェネレータからストリーミングする
+            # (全脆弱性をメモリに積まないためキャッシュはしない)
+            scan_result = db.query(ScanResult).filter(
+                ScanResult.sbom_id == sbom_id
+            ).order_by(ScanResult.scan_date.desc()).first()
+
+            if not scan_result:
+                raise HTTPException(status_code=404, detail="Scan result not found")
+
+            summary_data = {
+                "total_components": scan_result.total_components,
+                "vulnerable_count": scan_result.vulnerable_count,
+                "severity_counts": {
+                    "critical": scan_result.critical_count,
+                    "high": scan_result.high_count,
+                    "medium": scan_result.medium_count,
+                    "low": scan_result.low_count
+                }
+            }
+
+            logger.info(f"Report exported: SBOM ID={sbom_id}, format=csv")
+
+            return StreamingResponse(
+                _iter_csv_report(scan_result.id, summary_data),
+                media_type="text/csv",
+                headers={
+                    "Content-Disposition": f"attachment; filename=scan_report_{sbom_id}.csv",
+                    "ETag": etag
+                }
+            )
+
+        headers = {
+            "Content-Disposition": f"attachment; filename=scan_report_{sbom_id}.json",
+            "ETag": etag
+        }
+
+        # 生成済みレポートがあればreport_serviceを介さず返す
+        cache_key = f"scan:export:{sbom_id}:json"
+        cached = _cache_get(cache_key)
+        if cached:
+            return Response(content=cached, media_type="application/json", headers=headers)
+
+        # 最新のスキャン結果を取得し、脆弱性はカラム射影で一括取得
+        scan_result = _get_latest_scan(db, sbom_id)
+
         if not scan_result:
             raise HTTPException(status_code=404, detail="Scan result not found")
-        
-        # スキャンで検出された脆弱性の詳細を取得
-        scan_vulnerabilities = db.query(ScanVulnerability, Vulnerability).join(
-            Vulnerability,
-            ScanVulnerability.vulnerability_id == Vulnerability.id
-        ).filter(
-            ScanVulnerability.scan_result_id == scan_result.id
-        ).all()
-        
-        vulnerabilities = []
-        for scan_vuln, vuln in scan_vulnerabilities:
-            vulnerabilities.append({
-                "cve_id": vuln.cve_id,
-                "severity": vuln.severity,
-                "cvss_score": float(vuln.cvss_score) if vuln.cvss_score else None,
-                "cvss_vector": vuln.cvss_vector,
-                "description": vuln.description,
-                "component_name": scan_vuln.component_name,
-                "component_version": scan_vuln.component_version,
-                "published_date": vuln.published_date.isoformat() if vuln.published_date else None,
-                "references": vuln.references
-            })
-        
+
+        vulnerabilities = _fetch_vulnerability_rows(db, scan_result.id)
+
         scan_data = {
             "scan_id": scan_result.id,
             "sbom_id": str(scan_result.sbom_id),  # UUIDを文字列に変換
@@ -250,26 +412,14 @@ async def export_scan_report(
             "scan_duration_seconds": scan_result.scan_duration_seconds,
             "vulnerabilities": vulnerabilities
         }
-        
-        # レポート生成
-        if format == "json":
-            content = report_service.generate_json_report(scan_data)
-            media_type = "application/json"
-            filename = f"scan_report_{sbom_id}.json"
-        else:  # csv
-            content = report_service.generate_csv_report(scan_data)
-            media_type = "text/csv"
-            filename = f"scan_report_{sbom_id}.csv"
-        
-        logger.info(f"Report exported: SBOM ID={sbom_id}, format={format}")
-        
-        return Response(
-            content=content,
-            media_type=media_type,
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}"
-            }
-        )
+
+        content = report_service.generate_json_report(scan_data)
+
+        _cache_set(cache_key, content)
+
+        logger.info(f"Report exported: SBOM ID={sbom_id}, format=json")
+
+        return Response(content=content, media_type="application/json", headers=headers)
         
     except HTTPException:
         raise
@@ -279,44 +429,68 @@ async def export_scan_report(
 
 
 @router.get("/{sbom_id}/summary")
-async def get_scan_summary(
-    sbom_id: str,  # UUIDを文字列として受け取る
+def get_scan_summary(
+    sbom_id: UUID,  # パスパラメータの時点でUUIDとして検証される
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     """
     スキャン結果のサマリーを取得
     """
     try:
-        # UUIDに変換
-        try:
-            sbom_uuid = UUID(sbom_id)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid SBOM ID format")
-        
-        # 最新のスキャン結果を取得
-        scan_result = db.query(ScanResult).filter(
-            ScanResult.sbom_id == sbom_uuid
-        ).order_by(ScanResult.scan_date.desc()).first()
-        
-        if not scan_result:
+        # 軽量SELECTでETagを計算し、クライアントが最新なら304で打ち切る
+        _, etag = _latest_scan_etag(db, sbom_id)
+        if etag is None:
             raise HTTPException(status_code=404, detail="Scan result not found")
-        
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+
+        # キャッシュヒットなら本体クエリもreport_serviceも省略して返す
+        cache_key = f"scan:summary:{sbom_id}"
+        cached = _cache_get(cache_key)
+        if cached:
+            return {"success": True, "data": orjson.loads(cached)}
+
+        # 必要なスカラーカラムだけを射影して取得(ORMハイドレーションなし)
+        row = db.execute(
+            select(
+                ScanResult.id,
+                ScanResult.sbom_id,
+                ScanResult.scan_date,
+                ScanResult.total_components,
+                ScanResult.vulnerable_count,
+                ScanResult.critical_count,
+                ScanResult.high_count,
+                ScanResult.medium_count,
+                ScanResult.low_count
+            ).where(ScanResult.sbom_id == sbom_id)
+            .order_by(ScanResult.scan_date.desc())
+            .limit(1)
+        ).mappings().first()
+
+        if not row:
+            raise HTTPException(status_code=404, detail="Scan result not found")
+
         scan_data = {
-            "scan_id": scan_result.id,
-            "sbom_id": str(scan_result.sbom_id),  # UUIDを文字列に変換
-            "scan_date": scan_result.scan_date.isoformat(),
-            "total_components": scan_result.total_components,
-            "vulnerable_count": scan_result.vulnerable_count,
+            "scan_id": row["id"],
+            "sbom_id": str(row["sbom_id"]),  # UUIDを文字列に変換
+            "scan_date": row["scan_date"].isoformat(),
+            "total_components": row["total_components"],
+            "vulnerable_count": row["vulnerable_count"],
             "severity_counts": {
-                "critical": scan_result.critical_count,
-                "high": scan_result.high_count,
-                "medium": scan_result.medium_count,
-                "low": scan_result.low_count
+                "critical": row["critical_count"],
+                "high": row["high_count"],
+                "medium": row["medium_count"],
+                "low": row["low_count"]
             }
         }
         
         summary = report_service.generate_summary_report(scan_data)
-        
+
+        _cache_set(cache_key, orjson.dumps(summary).decode())
+
         return {
             "success": True,
             "data": summary
@@ -1,90 +1,240 @@
 """NVD API Service - CVE データ取得と脆弱性DB更新"""
+import asyncio
+import ciso8601
+import httpx
+import orjson
 import requests
 import time
-from datetime import datetime, timedelta
+from collections import deque
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any, Optional
 import logging
 from sqlalchemy.orm import Session
-from app.models import Vulnerability
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import delete, insert, select, text
+from app.models import Vulnerability, VulnerabilityProduct
 from app.config import settings
 
 logger = logging.getLogger(__name__)
 
 
+def _to_naive_utc(dt: datetime) -> datetime:
+    """
+    tz付きdatetimeをUTCのnaive datetimeに揃える
+
+    カラムはTIMESTAMP WITHOUT TIME ZONEなので、DBから読んだ値との
+    比較前にtzinfoを落としておく必要がある
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _build_cpe_entry(match: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    NVDのcpeMatch要素を保存用エントリに変換
+
+    criteriaの分解結果(vendor/product/version)もここで一度だけ計算して
+    構造化フィールドとして持たせる。criteriaは取り込み後に変わらない
+    データなので、スキャンのたびにsplitし直す必要がなくなる
+    """
+    entry = {
+        'criteria': match.get('criteria'),
+        'matchCriteriaId': match.get('matchCriteriaId'),
+        'versionStartIncluding': match.get('versionStartIncluding'),
+        'versionEndExcluding': match.get('versionEndExcluding'),
+        'versionStartExcluding': match.get('versionStartExcluding'),
+        'versionEndIncluding': match.get('versionEndIncluding')
+    }
+    # criteria形式: cpe:2.3:a:vendor:product:version:...
+    parts = (entry['criteria'] or '').split(':')
+    if len(parts) > 4:
+        entry['vendor'] = parts[3].lower()
+        entry['product'] = parts[4].lower()
+        if len(parts) > 5:
+            entry['version'] = parts[5].lower()
+    return entry
+
+
+class _AsyncRateLimiter:
+    """
+    NVD APIのレート制限(N リクエスト / 期間)を守るトークンバケット
+
+    固定スリープと違い、30秒の予算を使い切ったときだけ待つ。
+    ページ取得に時間がかかっている間はスリープが実質ゼロになる
+    """
+
+    def __init__(self, max_requests: int, period_seconds: float):
+        self.max_requests = max_requests
+        self.period_seconds = period_seconds
+        self._timestamps: deque = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """トークンを1つ取得(予算超過時は最古のトークン失効まで待機)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while (self._timestamps
+                       and now - self._timestamps[0] >= self.period_seconds):
+                    self._timestamps.popleft()
+                if len(self._timestamps) < self.max_requests:
+                    self._timestamps.append(now)
+                    return
+                await asyncio.sleep(
+                    self._timestamps[0] + self.period_seconds - now
+                )
+
+
 class NVDService:
     """NVD API連携サービス"""
-    
+
     BASE_URL = "https://services.nvd.nist.gov/rest/json/cves/2.0"
-    
+
+    # ページ取得の同時実行数(NVDのレート制限内でRTTを隠蔽する)
+    MAX_CONCURRENT_REQUESTS = 4
+
+    # 一括UPSERT時の1チャンクあたりの行数
+    UPSERT_CHUNK_SIZE = 500
+
+    # NVDレスポンスの上限サイズ(orjsonに再帰制限がないため念のためガード)
+    MAX_RESPONSE_BYTES = 50 * 1024 * 1024
+
     def __init__(self, api_key: Optional[str] = None):
         self.api_key = api_key or getattr(settings, 'NVD_API_KEY', None)
         self.headers = {}
         if self.api_key:
             self.headers['apiKey'] = self.api_key
-            self.rate_limit_delay = 0.6  # APIキーあり: 100リクエスト/分
+            # APIキーあり: 50リクエスト/30秒
+            self._rate_limit = (50, 30)
         else:
-            self.rate_limit_delay = 6.0  # APIキーなし: 10リクエスト/分
-    
-    def fetch_recent_cves(self, days: int = 30) -> List[Dict[str, Any]]:
+            # APIキーなし: 5リクエスト/30秒
+            self._rate_limit = (5, 30)
+
+        # 同期経路(fetch_cve_by_id)用のセッション
+        # keep-aliveでTCP+TLSハンドシェイクを呼び出し間で使い回し、
+        # 429/503には指数バックオフ付きでリトライする
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=3, backoff_factor=0.5, status_forcelist=[429, 503]
+            )
+        )
+        self.session.mount('https://', adapter)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        """
+        HTTP/2 + keep-alive対応のクライアントを生成
+
+        ページごとにTCP+TLSハンドシェイクをやり直さないよう、
+        1回の同期で同じ接続を使い回す
+        """
+        return httpx.AsyncClient(
+            http2=True,
+            headers=self.headers,
+            timeout=30,
+            limits=httpx.Limits(max_keepalive_connections=4)
+        )
+
+    def _parse_response_body(self, body: bytes) -> Dict[str, Any]:
+        """
+        NVDレスポンスボディをorjsonでパース
+
+        stdlib jsonより数倍速いC実装。サイズ上限を超えるボディは
+        パースせずに拒否する
+
+        Raises:
+            ValueError: ボディが大きすぎる、またはJSONとして不正な場合
+        """
+        if len(body) > self.MAX_RESPONSE_BYTES:
+            raise ValueError(
+                f"NVD response too large: {len(body)} bytes "
+                f"(limit {self.MAX_RESPONSE_BYTES})"
+            )
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON in NVD response: {str(e)}")
+
+    async def _fetch_page(self, client: httpx.AsyncClient,
+                          params: Dict[str, Any],
+                          semaphore: asyncio.Semaphore,
+                          rate_limiter: _AsyncRateLimiter) -> Dict[str, Any]:
+        """1ページ分のCVEを取得(セマフォ+待機でレート制限を遵守)"""
+        async with semaphore:
+            # レート制限の予算が残っていれば待ちなしで即発行される
+            await rate_limiter.acquire()
+            logger.info(f"Requesting CVEs from index {params['startIndex']}...")
+            response = await client.get(self.BASE_URL, params=params)
+            response.raise_for_status()
+            return self._parse_response_body(response.content)
+
+    async def fetch_recent_cves(self, days: int = 30) -> List[Dict[str, Any]]:
         """
         最近のCVEデータを取得
-        
+
+        最初の1ページでtotalResultsを確認し、残りのページは
+        セマフォで絞りながら並行取得する(ネットワーク待ちの重ね合わせ)
+
         Args:
             days: 過去何日分のデータを取得するか
-            
+
         Returns:
             CVEデータのリスト
         """
         logger.info(f"Fetching CVEs from last {days} days...")
-        
+
         end_date = datetime.utcnow()
         start_date = end_date - timedelta(days=days)
-        
-        all_cves = []
-        start_index = 0
+
         results_per_page = 2000  # NVD APIの最大値
-        
-        while True:
+        base_params = {
+            'pubStartDate': start_date.strftime('%Y-%m-%dT00:00:00.000'),
+            'pubEndDate': end_date.strftime('%Y-%m-%dT23:59:59.999'),
+            'resultsPerPage': results_per_page
+        }
+
+        all_cves = []
+        # asyncio.Lockは作成時のイベントループに束縛される。update_databaseは
+        # 同期のたびにasyncio.runで新しいループを回すため、リミッターと
+        # セマフォは呼び出しごとに作り直す(インスタンスに使い回すと
+        # 2回目以降の同期が "bound to a different event loop" で落ちる)
+        rate_limiter = _AsyncRateLimiter(*self._rate_limit)
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+
+        async with self._build_client() as client:
             try:
-                params = {
-                    'pubStartDate': start_date.strftime('%Y-%m-%dT00:00:00.000'),
-                    'pubEndDate': end_date.strftime('%Y-%m-%dT23:59:59.999'),
-                    'startIndex': start_index,
-                    'resultsPerPage': results_per_page
-                }
-                
-                logger.info(f"Requesting CVEs from index {start_index}...")
-                response = requests.get(
-                    self.BASE_URL,
-                    headers=self.headers,
-                    params=params,
-                    timeout=30
+                # 最初のページで総件数を確認
+                first_page = await self._fetch_page(
+                    client, {**base_params, 'startIndex': 0},
+                    semaphore, rate_limiter
                 )
-                response.raise_for_status()
-                
-                data = response.json()
-                vulnerabilities = data.get('vulnerabilities', [])
-                
-                if not vulnerabilities:
-                    break
-                
-                all_cves.extend(vulnerabilities)
-                logger.info(f"Retrieved {len(vulnerabilities)} CVEs")
-                
-                # 次のページがあるか確認
-                total_results = data.get('totalResults', 0)
-                if start_index + results_per_page >= total_results:
-                    break
-                
-                start_index += results_per_page
-                
-                # レート制限対策
-                time.sleep(self.rate_limit_delay)
-                
-            except requests.RequestException as e:
+                all_cves.extend(first_page.get('vulnerabilities', []))
+                total_results = first_page.get('totalResults', 0)
+
+                # 残りのページを並行取得
+                remaining_indexes = range(
+                    results_per_page, total_results, results_per_page
+                )
+                if remaining_indexes:
+                    pages = await asyncio.gather(*[
+                        self._fetch_page(
+                            client, {**base_params, 'startIndex': index},
+                            semaphore, rate_limiter
+                        )
+                        for index in remaining_indexes
+                    ])
+                    for page in pages:
+                        all_cves.extend(page.get('vulnerabilities', []))
+
+            except (httpx.HTTPError, ValueError) as e:
                 logger.error(f"Failed to fetch CVEs: {str(e)}")
-                break
-        
+
         logger.info(f"Total CVEs fetched: {len(all_cves)}")
         return all_cves
     
@@ -100,190 +250,320 @@ class NVDService:
         """
         try:
             params = {'cveId': cve_id}
-            response = requests.get(
+            response = self.session.get(
                 self.BASE_URL,
-                headers=self.headers,
                 params=params,
                 timeout=15
             )
             response.raise_for_status()
-            
-            data = response.json()
+
+            data = self._parse_response_body(response.content)
             vulnerabilities = data.get('vulnerabilities', [])
-            
+
             if vulnerabilities:
                 return vulnerabilities[0]
-            
+
             return None
-            
-        except requests.RequestException as e:
+
+        except (requests.RequestException, ValueError) as e:
             logger.error(f"Failed to fetch CVE {cve_id}: {str(e)}")
             return None
     
+    def _parse_cve(self, cve_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        NVD APIのCVEデータをvulnerabilitiesテーブルの行dictに変換
+
+        DBに触らない純粋な変換処理。一括UPSERTと単体保存の両方で使う
+
+        Args:
+            cve_data: NVD APIから取得したCVEデータ
+
+        Returns:
+            カラム名→値のdict、CVE IDが無い場合None
+        """
+        cve = cve_data.get('cve', {})
+        cve_id = cve.get('id')
+
+        if not cve_id:
+            logger.warning("CVE ID not found in data")
+            return None
+
+        # CVSS情報の抽出
+        cvss_score = None
+        cvss_vector = None
+        severity = "UNKNOWN"
+
+        metrics = cve.get('metrics', {})
+
+        # CVSS 3.x を優先
+        if 'cvssMetricV31' in metrics and metrics['cvssMetricV31']:
+            cvss_data = metrics['cvssMetricV31'][0].get('cvssData', {})
+            cvss_score = cvss_data.get('baseScore')
+            cvss_vector = cvss_data.get('vectorString')
+            severity = cvss_data.get('baseSeverity', 'UNKNOWN')
+        elif 'cvssMetricV30' in metrics and metrics['cvssMetricV30']:
+            cvss_data = metrics['cvssMetricV30'][0].get('cvssData', {})
+            cvss_score = cvss_data.get('baseScore')
+            cvss_vector = cvss_data.get('vectorString')
+            severity = cvss_data.get('baseSeverity', 'UNKNOWN')
+        elif 'cvssMetricV2' in metrics and metrics['cvssMetricV2']:
+            cvss_data = metrics['cvssMetricV2'][0].get('cvssData', {})
+            cvss_score = cvss_data.get('baseScore')
+            cvss_vector = cvss_data.get('vectorString')
+            # CVSS v2には severity がないのでスコアから判定
+            if cvss_score:
+                if cvss_score >= 9.0:
+                    severity = "CRITICAL"
+                elif cvss_score >= 7.0:
+                    severity = "HIGH"
+                elif cvss_score >= 4.0:
+                    severity = "MEDIUM"
+                else:
+                    severity = "LOW"
+
+        # 説明文の取得
+        descriptions = cve.get('descriptions', [])
+        description = ""
+        for desc in descriptions:
+            if desc.get('lang') == 'en':
+                description = desc.get('value', '')
+                break
+
+        # CPEマッチ情報の抽出
+        # 3重forの逐次appendではなく1本の内包表記でフラット化する
+        # (CPython側のフレーム/アロケータのオーバーヘッドを削減。
+        # dict形状はJSONBで保存しscanner側が参照するため維持)
+        cpe_match = [
+            _build_cpe_entry(match)
+            for config in cve.get('configurations', ())
+            for node in config.get('nodes', ())
+            for match in node.get('cpeMatch', ())
+            if match.get('vulnerable', False)
+        ]
+
+        # 参考リンク
+        references = []
+        for ref in cve.get('references', []):
+            references.append({
+                'url': ref.get('url'),
+                'source': ref.get('source')
+            })
+
+        # 日付情報
+        # ciso8601はC実装でZサフィックスも直接扱えるため、
+        # .replace('Z', ...)の文字列コピー + fromisoformatより大幅に速い
+        published_date = cve.get('published')
+        modified_date = cve.get('lastModified')
+
+        if published_date:
+            published_date = _to_naive_utc(ciso8601.parse_datetime(published_date))
+        if modified_date:
+            modified_date = _to_naive_utc(ciso8601.parse_datetime(modified_date))
+
+        return {
+            'cve_id': cve_id,
+            'severity': severity,
+            'description': description,
+            'cvss_score': cvss_score,
+            'cvss_vector': cvss_vector,
+            'published_date': published_date,
+            'modified_date': modified_date,
+            'cpe_match': cpe_match,
+            'references': references,
+            'updated_at': datetime.utcnow()
+        }
+
+    @staticmethod
+    def _extract_cpe_products(cpe_match: List[Dict[str, Any]]) -> set:
+        """
+        cpe_matchエントリから(製品名, ベンダー名)の集合を抽出
+
+        vulnerability_productsテーブルの非正規化行の元データになる
+        """
+        products = set()
+        for match in cpe_match:
+            # _build_cpe_entryが取り込み時に分解済み
+            product = match.get('product')
+            if not product:
+                continue
+            products.add((product, match.get('vendor') or None))
+        return products
+
+    def _refresh_vulnerability_products(self, db: Session,
+                                        vuln_ids: List[int],
+                                        product_rows: List[Dict[str, Any]]):
+        """
+        指定した脆弱性のvulnerability_products行を入れ替える
+
+        DELETE + 一括INSERT。呼び出し側のトランザクション内で実行される
+        """
+        db.execute(
+            delete(VulnerabilityProduct)
+            .where(VulnerabilityProduct.vulnerability_id.in_(vuln_ids))
+        )
+        if product_rows:
+            db.execute(insert(VulnerabilityProduct), product_rows)
+
     def save_vulnerability_to_db(self, db: Session, cve_data: Dict[str, Any]) -> Optional[Vulnerability]:
         """
         CVEデータをデータベースに保存
-        
+
+        flushのみでcommitはしない。呼び出し側が適当な粒度(数百件ごと等)で
+        commitすることで、1件ごとのfsyncを避けられる
+
         Args:
             db: データベースセッション
             cve_data: NVD APIから取得したCVEデータ
-            
+
         Returns:
             保存されたVulnerabilityオブジェクト
         """
+        cve_id = None
         try:
-            cve = cve_data.get('cve', {})
-            cve_id = cve.get('id')
-            
-            if not cve_id:
-                logger.warning("CVE ID not found in data")
+            row = self._parse_cve(cve_data)
+            if row is None:
                 return None
-            
-            # 既存レコードを確認
-            existing = db.query(Vulnerability).filter(Vulnerability.cve_id == cve_id).first()
-            
-            # CVSS情報の抽出
-            cvss_score = None
-            cvss_vector = None
-            severity = "UNKNOWN"
-            
-            metrics = cve.get('metrics', {})
-            
-            # CVSS 3.x を優先
-            if 'cvssMetricV31' in metrics and metrics['cvssMetricV31']:
-                cvss_data = metrics['cvssMetricV31'][0].get('cvssData', {})
-                cvss_score = cvss_data.get('baseScore')
-                cvss_vector = cvss_data.get('vectorString')
-                severity = cvss_data.get('baseSeverity', 'UNKNOWN')
-            elif 'cvssMetricV30' in metrics and metrics['cvssMetricV30']:
-                cvss_data = metrics['cvssMetricV30'][0].get('cvssData', {})
-                cvss_score = cvss_data.get('baseScore')
-                cvss_vector = cvss_data.get('vectorString')
-                severity = cvss_data.get('baseSeverity', 'UNKNOWN')
-            elif 'cvssMetricV2' in metrics and metrics['cvssMetricV2']:
-                cvss_data = metrics['cvssMetricV2'][0].get('cvssData', {})
-                cvss_score = cvss_data.get('baseScore')
-                cvss_vector = cvss_data.get('vectorString')
-                # CVSS v2には severity がないのでスコアから判定
-                if cvss_score:
-                    if cvss_score >= 9.0:
-                        severity = "CRITICAL"
-                    elif cvss_score >= 7.0:
-                        severity = "HIGH"
-                    elif cvss_score >= 4.0:
-                        severity = "MEDIUM"
-                    else:
-                        severity = "LOW"
-            
-            # 説明文の取得
-            descriptions = cve.get('descriptions', [])
-            description = ""
-            for desc in descriptions:
-                if desc.get('lang') == 'en':
-                    description = desc.get('value', '')
-                    break
-            
-            # CPEマッチ情報の抽出
-            configurations = cve.get('configurations', [])
-            cpe_match = []
-            for config in configurations:
-                for node in config.get('nodes', []):
-                    for match in node.get('cpeMatch', []):
-                        if match.get('vulnerable', False):
-                            cpe_match.append({
-                                'criteria': match.get('criteria'),
-                                'matchCriteriaId': match.get('matchCriteriaId'),
-                                'versionStartIncluding': match.get('versionStartIncluding'),
-                                'versionEndExcluding': match.get('versionEndExcluding'),
-                                'versionStartExcluding': match.get('versionStartExcluding'),
-                                'versionEndIncluding': match.get('versionEndIncluding')
-                            })
-            
-            # 参考リンク
-            references = []
-            for ref in cve.get('references', []):
-                references.append({
-                    'url': ref.get('url'),
-                    'source': ref.get('source')
-                })
-            
-            # 日付情報
-            published_date = cve.get('published')
-            modified_date = cve.get('lastModified')
-            
-            if published_date:
-                published_date = datetime.fromisoformat(published_date.replace('Z', '+00:00'))
-            if modified_date:
-                modified_date = datetime.fromisoformat(modified_date.replace('Z', '+00:00'))
-            
+            cve_id = row['cve_id']
+
             # 既存レコードの更新または新規作成
+            existing = db.query(Vulnerability).filter(Vulnerability.cve_id == cve_id).first()
             if existing:
-                existing.severity = severity
-                existing.description = description
-                existing.cvss_score = cvss_score
-                existing.cvss_vector = cvss_vector
-                existing.published_date = published_date
-                existing.modified_date = modified_date
-                existing.cpe_match = cpe_match
-                existing.references = references
-                existing.updated_at = datetime.utcnow()
-                db.commit()
+                # lastModifiedが進んでいなければ書き込み不要
+                if (existing.modified_date and row['modified_date']
+                        and existing.modified_date >= row['modified_date']):
+                    logger.debug(f"CVE unchanged, skipping update: {cve_id}")
+                    return existing
+                for key, value in row.items():
+                    setattr(existing, key, value)
+                db.flush()
+                vulnerability = existing
                 logger.info(f"Updated CVE: {cve_id}")
-                return existing
             else:
-                vulnerability = Vulnerability(
-                    cve_id=cve_id,
-                    severity=severity,
-                    description=description,
-                    cvss_score=cvss_score,
-                    cvss_vector=cvss_vector,
-                    published_date=published_date,
-                    modified_date=modified_date,
-                    cpe_match=cpe_match,
-                    references=references
-                )
+                vulnerability = Vulnerability(**row)
                 db.add(vulnerability)
-                db.commit()
+                db.flush()
                 logger.info(f"Saved new CVE: {cve_id}")
-                return vulnerability
-                
+
+            # 非正規化した製品名行も同期する
+            self._refresh_vulnerability_products(
+                db,
+                [vulnerability.id],
+                [
+                    {'vulnerability_id': vulnerability.id,
+                     'product': product, 'vendor': vendor}
+                    for product, vendor in self._extract_cpe_products(row['cpe_match'])
+                ]
+            )
+            return vulnerability
+
         except Exception as e:
             logger.error(f"Failed to save vulnerability {cve_id}: {str(e)}", exc_info=True)
             db.rollback()
             return None
-    
+
     def update_database(self, db: Session, days: int = 30) -> Dict[str, int]:
         """
         脆弱性データベースを更新
-        
+
+        取得した全CVEをメモリ上で行dictに変換し、チャンク単位の
+        INSERT ... ON CONFLICT DO UPDATEで一括UPSERTする
+        (行ごとのSELECT+commitを排除してDB往復とfsyncを削減)
+
         Args:
             db: データベースセッション
             days: 過去何日分のデータを取得するか
-            
+
         Returns:
             統計情報
         """
         logger.info("Starting NVD database update...")
-        
-        cves = self.fetch_recent_cves(days=days)
-        
+
+        cves = asyncio.run(self.fetch_recent_cves(days=days))
+
         stats = {
             'total_fetched': len(cves),
             'new_count': 0,
             'updated_count': 0,
+            'skipped_count': 0,
             'failed_count': 0
         }
-        
+
+        # パースしてcve_idで重複排除
+        # (同一INSERT内の重複はON CONFLICT DO UPDATEでエラーになる)
+        rows_by_id: Dict[str, Dict[str, Any]] = {}
         for cve_data in cves:
-            result = self.save_vulnerability_to_db(db, cve_data)
-            if result:
-                if result.created_at >= datetime.utcnow() - timedelta(minutes=1):
-                    stats['new_count'] += 1
-                else:
-                    stats['updated_count'] += 1
+            try:
+                row = self._parse_cve(cve_data)
+            except Exception as e:
+                logger.error(f"Failed to parse CVE data: {str(e)}", exc_info=True)
+                row = None
+            if row:
+                rows_by_id[row['cve_id']] = row
             else:
                 stats['failed_count'] += 1
-        
+
+        rows = list(rows_by_id.values())
+        update_columns = (
+            'severity', 'description', 'cvss_score', 'cvss_vector',
+            'modified_date', 'cpe_match', 'references', 'updated_at'
+        )
+
+        for offset in range(0, len(rows), self.UPSERT_CHUNK_SIZE):
+            chunk = rows[offset:offset + self.UPSERT_CHUNK_SIZE]
+            try:
+                # lastModifiedが進んでいない既存行はUPSERT対象から外す
+                # (日次の再同期では大半が未変更でWAL書き込みの無駄になる)
+                existing_dates = dict(db.execute(
+                    select(Vulnerability.cve_id, Vulnerability.modified_date)
+                    .where(Vulnerability.cve_id.in_([r['cve_id'] for r in chunk]))
+                ).all())
+                fresh_rows = [
+                    r for r in chunk
+                    if not (
+                        r['modified_date']
+                        and (stored := existing_dates.get(r['cve_id']))
+                        and stored >= r['modified_date']
+                    )
+                ]
+                stats['skipped_count'] += len(chunk) - len(fresh_rows)
+                if not fresh_rows:
+                    db.rollback()
+                    continue
+
+                stmt = pg_insert(Vulnerability).values(fresh_rows)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['cve_id'],
+                    set_={col: stmt.excluded[col] for col in update_columns}
+                # xmax = 0 なら新規INSERT、それ以外は既存行のUPDATE
+                ).returning(
+                    Vulnerability.id, Vulnerability.cve_id, text('xmax = 0')
+                )
+                returned = db.execute(stmt).all()
+
+                # UPSERTした行のvulnerability_productsを同一トランザクションで入れ替える
+                products_by_cve = {
+                    r['cve_id']: self._extract_cpe_products(r['cpe_match'])
+                    for r in fresh_rows
+                }
+                product_rows = [
+                    {'vulnerability_id': vuln_id,
+                     'product': product, 'vendor': vendor}
+                    for vuln_id, row_cve_id, _ in returned
+                    for product, vendor in products_by_cve.get(row_cve_id, ())
+                ]
+                self._refresh_vulnerability_products(
+                    db, [vuln_id for vuln_id, _, _ in returned], product_rows
+                )
+                db.commit()
+
+                new_count = sum(1 for _, _, inserted in returned if inserted)
+                stats['new_count'] += new_count
+                stats['updated_count'] += len(returned) - new_count
+            except Exception as e:
+                logger.error(f"Failed to upsert CVE chunk: {str(e)}", exc_info=True)
+                db.rollback()
+                stats['failed_count'] += len(chunk)
+
         logger.info(f"NVD update completed: {stats}")
         return stats
 
@@ -1,27 +1,49 @@
 """Report Generation Service - JSON and CSV export"""
-import json
+import orjson
 import csv
-import io
-from typing import Dict, Any, List
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Any, Iterator, List, Tuple
 from datetime import datetime
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class _LineBuffer:
+    """csv.writerの書き込み先
+
+    書き込まれた行を溜めてdrain()でまとめて取り出す。
+    writerows()のC実装バッチ書き込みと、チャンク単位のyieldを両立する
+    """
+
+    def __init__(self):
+        self._lines: List[str] = []
+
+    def write(self, line: str) -> None:
+        self._lines.append(line)
+
+    def drain(self) -> str:
+        data = "".join(self._lines)
+        self._lines.clear()
+        return data
+
+
 class ReportService:
     """レポート生成サービス"""
     
     @staticmethod
-    def generate_json_report(scan_data: Dict[str, Any]) -> str:
+    def generate_json_report(scan_data: Dict[str, Any]) -> bytes:
         """
         JSON形式のレポートを生成
-        
+
         Args:
             scan_data: スキャン結果データ
-            
+
         Returns:
-            JSON文字列
+            UTF-8エンコード済みのJSONバイト列
+            (orjsonはbytesを直接出力するため、strへのデコードを挟まず
+            そのままレスポンス/キャッシュに渡す)
         """
         try:
             report = {
@@ -43,67 +65,102 @@ class ReportService:
                 "vulnerabilities": scan_data.get("vulnerabilities", [])
             }
             
-            return json.dumps(report, indent=2, ensure_ascii=False)
+            # orjsonはC実装でstdlib jsonより数倍速い(非ASCIIもそのまま出力)
+            return orjson.dumps(
+                report, option=orjson.OPT_INDENT_2 | orjson.OPT_NAIVE_UTC
+            )
             
         except Exception as e:
             logger.error(f"Failed to generate JSON report: {str(e)}", exc_info=True)
             raise
     
+    # writerows()でまとめて書き出す1チャンクあたりの行数
+    CSV_BATCH_ROWS = 1000
+
+    @staticmethod
+    def iter_csv_report(scan_data: Dict[str, Any]) -> Iterator[str]:
+        """
+        CSV形式のレポートをチャンク単位で生成
+
+        脆弱性行はCSV_BATCH_ROWS行ごとにwriterows()でまとめて書き出す
+        (C実装のバッチ書き込みで1行ごとのPython呼び出しを省く)。
+        全体をStringIOに蓄積しないため、StreamingResponseに渡しても
+        レポート全体をメモリに持たない
+
+        Args:
+            scan_data: スキャン結果データ。"vulnerabilities"はリストでも
+                ジェネレータでもよい(DBカーソルから直接流す呼び出し側が
+                行dictのイテレータを渡せる)
+
+        Yields:
+            CSVのチャンク(複数行)
+        """
+        buffer = _LineBuffer()
+        writer = csv.writer(buffer)
+
+        # ヘッダー行
+        writer.writerow([
+            "CVE ID",
+            "Severity",
+            "CVSS Score",
+            "Component Name",
+            "Component Version",
+            "Description",
+            "Published Date",
+            "CVSS Vector"
+        ])
+        yield buffer.drain()
+
+        # 脆弱性データ(vuln.getの束縛は行ごとに1回だけ)
+        vulnerabilities = iter(scan_data.get("vulnerabilities", []))
+        batch = ReportService.CSV_BATCH_ROWS
+        while True:
+            chunk = list(islice(vulnerabilities, batch))
+            if not chunk:
+                break
+            writer.writerows([
+                [
+                    g("cve_id", ""),
+                    g("severity", ""),
+                    g("cvss_score", ""),
+                    g("component_name", ""),
+                    g("component_version", ""),
+                    g("description", "")[:200],  # 200文字に制限
+                    g("published_date", ""),
+                    g("cvss_vector", "")
+                ]
+                for vuln in chunk
+                for g in (vuln.get,)
+            ])
+            yield buffer.drain()
+
+        # サマリー情報を追加
+        severity_counts = scan_data.get("severity_counts", {})
+        writer.writerows([
+            [],  # 空行
+            ["Summary"],
+            ["Total Components", scan_data.get("total_components", 0)],
+            ["Vulnerable Components", scan_data.get("vulnerable_count", 0)],
+            ["Critical", severity_counts.get("critical", 0)],
+            ["High", severity_counts.get("high", 0)],
+            ["Medium", severity_counts.get("medium", 0)],
+            ["Low", severity_counts.get("low", 0)]
+        ])
+        yield buffer.drain()
+
     @staticmethod
     def generate_csv_report(scan_data: Dict[str, Any]) -> str:
         """
-        CSV形式のレポートを生成
-        
+        CSV形式のレポートを生成(後方互換の全文版)
+
         Args:
             scan_data: スキャン結果データ
-            
+
         Returns:
             CSV文字列
         """
         try:
-            output = io.StringIO()
-            
-            # CSVライター作成
-            writer = csv.writer(output)
-            
-            # ヘッダー行
-            writer.writerow([
-                "CVE ID",
-                "Severity",
-                "CVSS Score",
-                "Component Name",
-                "Component Version",
-                "Description",
-                "Published Date",
-                "CVSS Vector"
-            ])
-            
-            # 脆弱性データを書き込み
-            vulnerabilities = scan_data.get("vulnerabilities", [])
-            for vuln in vulnerabilities:
-                writer.writerow([
-                    vuln.get("cve_id", ""),
-                    vuln.get("severity", ""),
-                    vuln.get("cvss_score", ""),
-                    vuln.get("component_name", ""),
-                    vuln.get("component_version", ""),
-                    vuln.get("description", "")[:200],  # 200文字に制限
-                    vuln.get("published_date", ""),
-                    vuln.get("cvss_vector", "")
-                ])
-            
-            # サマリー情報を追加
-            writer.writerow([])  # 空行
-            writer.writerow(["Summary"])
-            writer.writerow(["Total Components", scan_data.get("total_components", 0)])
-            writer.writerow(["Vulnerable Components", scan_data.get("vulnerable_count", 0)])
-            writer.writerow(["Critical", scan_data.get("severity_counts", {}).get("critical", 0)])
-            writer.writerow(["High", scan_data.get("severity_counts", {}).get("high", 0)])
-            writer.writerow(["Medium", scan_data.get("severity_counts", {}).get("medium", 0)])
-            writer.writerow(["Low", scan_data.get("severity_counts", {}).get("low", 0)])
-            
-            return output.getvalue()
-            
+            return "".join(ReportService.iter_csv_report(scan_data))
         except Exception as e:
             logger.error(f"Failed to generate CSV report: {str(e)}", exc_info=True)
             raise
@@ -122,15 +179,12 @@ class ReportService:
         try:
             severity_counts = scan_data.get("severity_counts", {})
             total_vulnerabilities = sum(severity_counts.values())
-            
-            # 深刻度別の割合を計算
-            severity_percentages = {}
-            if total_vulnerabilities > 0:
-                for severity, count in severity_counts.items():
-                    severity_percentages[severity] = round((count / total_vulnerabilities) * 100, 1)
-            else:
-                severity_percentages = {k: 0 for k in severity_counts.keys()}
-            
+
+            # 深刻度別の割合(同じカウントの組はキャッシュから返る)
+            severity_percentages = dict(
+                ReportService._severity_percentages(tuple(severity_counts.items()))
+            )
+
             # リスクレベルの判定
             critical_count = severity_counts.get("critical", 0)
             high_count = severity_counts.get("high", 0)
@@ -153,7 +207,11 @@ class ReportService:
                 "severity_counts": severity_counts,
                 "severity_percentages": severity_percentages,
                 "risk_level": risk_level,
-                "recommendations": ReportService._generate_recommendations(scan_data)
+                "recommendations": list(ReportService._generate_recommendations(
+                    critical_count,
+                    high_count,
+                    severity_counts.get("medium", 0)
+                ))
             }
             
         except Exception as e:
@@ -161,23 +219,50 @@ class ReportService:
             raise
     
     @staticmethod
-    def _generate_recommendations(scan_data: Dict[str, Any]) -> List[str]:
+    @lru_cache(maxsize=1024)
+    def _severity_percentages(counts_items: Tuple[Tuple[str, int], ...]) -> Tuple[Tuple[str, float], ...]:
+        """
+        深刻度別の割合を計算
+
+        ダッシュボードのポーリングで同じカウントの組が繰り返し来るため
+        lru_cacheでメモ化する。キー/戻り値ともタプル
+        (キャッシュされた辞書を呼び出し側が共有・変更しないため)
+
+        Args:
+            counts_items: severity_counts.items()のタプル
+
+        Returns:
+            (深刻度, 割合)のタプル
+        """
+        total = sum(count for _, count in counts_items)
+        if total > 0:
+            return tuple(
+                (severity, round((count / total) * 100, 1))
+                for severity, count in counts_items
+            )
+        return tuple((severity, 0) for severity, _ in counts_items)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _generate_recommendations(
+        critical_count: int, high_count: int, medium_count: int
+    ) -> Tuple[str, ...]:
         """
         推奨事項を生成
-        
+
+        3つのカウントにしか依存しないため、同じ組み合わせは
+        f-stringの組み立てごとキャッシュから返す
+
         Args:
-            scan_data: スキャン結果データ
-            
+            critical_count: CRITICAL件数
+            high_count: HIGH件数
+            medium_count: MEDIUM件数
+
         Returns:
-            推奨事項のリスト
+            推奨事項のタプル
         """
         recommendations = []
-        severity_counts = scan_data.get("severity_counts", {})
-        
-        critical_count = severity_counts.get("critical", 0)
-        high_count = severity_counts.get("high", 0)
-        medium_count = severity_counts.get("medium", 0)
-        
+
         if critical_count > 0:
             recommendations.append(
                 f"🔴 {critical_count}件のCRITICAL脆弱性が検出されました。直ちに対応してください。"
@@ -201,8 +286,8 @@ class ReportService:
         recommendations.append(
             "💡 定期的なスキャンを実施して、最新の脆弱性情報を確認してください。"
         )
-        
-        return recommendations
+
+        return tuple(recommendations)
 
 
 # シングルトンインスタンス
@@ -1,10 +1,20 @@
 """SBOM Parser Service - CycloneDX and SPDX format support"""
-import json
-import xml.etree.ElementTree as ET
+from io import BytesIO
+from lxml import etree
 from typing import Dict, List, Any, Optional
 from datetime import datetime
 import logging
 
+# C実装のyajl2バックエンドが使えればそちらを優先する
+# (バックエンドモジュールはitems/parse等のみで例外クラスを持たないため、
+# JSONErrorはトップレベルパッケージから取る)
+from ijson import JSONError
+
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
+
 logger = logging.getLogger(__name__)
 
 
@@ -60,42 +70,65 @@ class SBOMParser:
     
     @staticmethod
     def _parse_json(content: bytes) -> Dict[str, Any]:
-        """JSON形式のSBOMを解析"""
+        """JSON形式のSBOMを解析
+
+        ijsonのストリーミングパースで必要なパスだけを抽出し、
+        SBOM全体の辞書をメモリに構築しない
+        """
         try:
-            data = json.loads(content.decode('utf-8'))
-            
+            fmt = SBOMParser._detect_json_format(content)
+
             # CycloneDX JSON
-            if "bomFormat" in data and data["bomFormat"] == "CycloneDX":
-                return CycloneDXParser.parse_json(data)
-            
+            if fmt == 'cyclonedx':
+                return CycloneDXParser.parse_json(content)
+
             # SPDX JSON
-            elif "spdxVersion" in data:
-                return SPDXParser.parse_json(data)
-            
+            elif fmt == 'spdx':
+                return SPDXParser.parse_json(content)
+
             else:
                 raise SBOMParserException("Unknown SBOM format in JSON")
-                
-        except json.JSONDecodeError as e:
+
+        except JSONError as e:
             raise SBOMParserException(f"Invalid JSON: {str(e)}")
+
+    @staticmethod
+    def _detect_json_format(content: bytes) -> Optional[str]:
+        """トップレベルのキーから形式を判定
+
+        kvitemsは各キーの値を完全に構築してしまう(components配列で
+        全体ロードと同じになる)ため、parseイベントを走査して
+        判定キーが見つかった時点で打ち切る
+        """
+        for prefix, event, value in ijson.parse(BytesIO(content)):
+            if prefix == 'bomFormat' and value == 'CycloneDX':
+                return 'cyclonedx'
+            if prefix == 'spdxVersion':
+                return 'spdx'
+        return None
     
     @staticmethod
     def _parse_xml(content: bytes) -> Dict[str, Any]:
-        """XML形式のSBOMを解析"""
+        """XML形式のSBOMを解析
+
+        DOM全体を構築せずlxmlのiterparseでストリーム処理する。
+        形式判定は先頭2KBの部分文字列で行い、パース前にどちらの
+        パーサーを使うか決める
+        """
+        head = content[:2048].lower()
         try:
-            root = ET.fromstring(content.decode('utf-8'))
-            
             # CycloneDX XML
-            if 'cyclonedx' in root.tag.lower():
-                return CycloneDXParser.parse_xml(root)
-            
+            if b'cyclonedx' in head:
+                return CycloneDXParser.parse_xml(content)
+
             # SPDX XML
-            elif 'spdx' in root.tag.lower():
-                return SPDXParser.parse_xml(root)
-            
+            elif b'spdx' in head:
+                return SPDXParser.parse_xml(content)
+
             else:
                 raise SBOMParserException("Unknown SBOM format in XML")
-                
-        except ET.ParseError as e:
+
+        except etree.XMLSyntaxError as e:
             raise SBOMParserException(f"Invalid XML: {str(e)}")
 
 
@@ -103,65 +136,109 @@ class CycloneDXParser:
     """CycloneDX形式のパーサー"""
     
     @staticmethod
-    def parse_json(data: Dict[str, Any]) -> Dict[str, Any]:
-        """CycloneDX JSON形式を解析"""
-        components = []
-        
-        # コンポーネントリストの抽出
-        for comp in data.get("components", []):
-            component = Component(
+    def parse_json(content: bytes) -> Dict[str, Any]:
+        """CycloneDX JSON形式をストリーム解析
+
+        components配列は要素単位でComponentに変換し、配列全体の
+        中間辞書を作らない。raw_dataは返さない(呼び出し側は原本の
+        バイト列を別途保持している)
+        """
+        # コンポーネントリストの抽出(要素ごとに小さな辞書だけ作られる)
+        components = [
+            Component(
                 name=comp.get("name", "unknown"),
                 version=comp.get("version", "unknown"),
                 purl=comp.get("purl"),
                 component_type=comp.get("type", "library")
             )
-            components.append(component)
-        
-        # メタデータの抽出
-        metadata = data.get("metadata", {})
-        
+            for comp in ijson.items(BytesIO(content), 'components.item',
+                                    use_float=True)
+        ]
+
+        # メタデータ(小さなサブオブジェクトのみ構築)
+        metadata = next(
+            ijson.items(BytesIO(content), 'metadata', use_float=True), {}
+        ) or {}
+
+        # トップレベルのスカラーはイベント走査で拾い、揃い次第打ち切る
+        spec_version = serial_number = None
+        for prefix, event, value in ijson.parse(BytesIO(content)):
+            if prefix == 'specVersion':
+                spec_version = value
+            elif prefix == 'serialNumber':
+                serial_number = value
+            if spec_version is not None and serial_number is not None:
+                break
+
         return {
             "format": "cyclonedx",
-            "version": data.get("specVersion", "unknown"),
+            "version": spec_version or "unknown",
             "components": components,
             "metadata": {
                 "timestamp": metadata.get("timestamp"),
                 "tools": metadata.get("tools", []),
                 "component": metadata.get("component", {})
             },
-            "serial_number": data.get("serialNumber"),
-            "raw_data": data
+            "serial_number": serial_number
         }
     
     @staticmethod
-    def parse_xml(root: ET.Element) -> Dict[str, Any]:
-        """CycloneDX XML形式を解析"""
+    def parse_xml(content: bytes) -> Dict[str, Any]:
+        """CycloneDX XML形式をiterparseでストリーム解析
+
+        component要素のend毎にComponentを組み立てて即座に要素を解放する
+        ため、DOM全体をメモリに保持しない。タグはローカル名で比較し、
+        スキーマバージョン(1.3/1.4/1.5)の名前空間差異に依存しない
+        """
         components = []
-        
-        # 名前空間を取得
-        ns = {'': 'http://cyclonedx.org/schema/bom/1.4'}
-        
-        # コンポーネントの抽出
-        for comp in root.findall('.//components/component', ns):
-            name_elem = comp.find('name', ns)
-            version_elem = comp.find('version', ns)
-            purl_elem = comp.find('purl', ns)
-            
-            component = Component(
-                name=name_elem.text if name_elem is not None else "unknown",
-                version=version_elem.text if version_elem is not None else "unknown",
-                purl=purl_elem.text if purl_elem is not None else None,
-                component_type=comp.get('type', 'library')
-            )
-            components.append(component)
-        
+        root_attrib: Dict[str, str] = {}
+
+        context = etree.iterparse(BytesIO(content), events=('start', 'end'))
+        root_seen = False
+        for event, elem in context:
+            if event == 'start':
+                if not root_seen:
+                    # ルート要素の属性(version, serialNumber)を先に確保
+                    root_attrib = dict(elem.attrib)
+                    root_seen = True
+                continue
+
+            if not isinstance(elem.tag, str) or etree.QName(elem).localname != 'component':
+                continue
+            parent = elem.getparent()
+            if parent is None or etree.QName(parent).localname != 'components':
+                continue
+
+            name = version = purl = None
+            for child in elem:
+                if not isinstance(child.tag, str):
+                    continue
+                local = etree.QName(child).localname
+                if local == 'name':
+                    name = child.text
+                elif local == 'version':
+                    version = child.text
+                elif local == 'purl':
+                    purl = child.text
+
+            components.append(Component(
+                name=name or "unknown",
+                version=version or "unknown",
+                purl=purl,
+                component_type=elem.get('type', 'library')
+            ))
+
+            # 処理済みの要素と先行する兄弟を解放してメモリを抑える
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
         return {
             "format": "cyclonedx",
-            "version": root.get("version", "unknown"),
+            "version": root_attrib.get("version", "unknown"),
             "components": components,
             "metadata": {},
-            "serial_number": root.get("serialNumber"),
-            "raw_data": {}
+            "serial_number": root_attrib.get("serialNumber")
         }
 
 
@@ -169,60 +246,92 @@ class SPDXParser:
     """SPDX形式のパーサー"""
     
     @staticmethod
-    def parse_json(data: Dict[str, Any]) -> Dict[str, Any]:
-        """SPDX JSON形式を解析"""
-        components = []
-        
+    def parse_json(content: bytes) -> Dict[str, Any]:
+        """SPDX JSON形式をストリーム解析"""
         # パッケージリストの抽出
-        for pkg in data.get("packages", []):
-            # SPDX形式ではバージョンがname内に含まれることが多い
-            name = pkg.get("name", "unknown")
-            version = pkg.get("versionInfo", "unknown")
-            
-            component = Component(
-                name=name,
-                version=version,
+        # (SPDX形式ではバージョンがname内に含まれることが多い)
+        components = [
+            Component(
+                name=pkg.get("name", "unknown"),
+                version=pkg.get("versionInfo", "unknown"),
                 purl=None,  # SPDXにはpurlがない場合が多い
                 component_type="library"
             )
-            components.append(component)
-        
+            for pkg in ijson.items(BytesIO(content), 'packages.item',
+                                   use_float=True)
+        ]
+
+        creation_info = next(
+            ijson.items(BytesIO(content), 'creationInfo', use_float=True), {}
+        ) or {}
+
+        spdx_version = document_name = None
+        for prefix, event, value in ijson.parse(BytesIO(content)):
+            if prefix == 'spdxVersion':
+                spdx_version = value
+            elif prefix == 'name':
+                document_name = value
+            if spdx_version is not None and document_name is not None:
+                break
+
         return {
             "format": "spdx",
-            "version": data.get("spdxVersion", "unknown"),
+            "version": spdx_version or "unknown",
             "components": components,
             "metadata": {
-                "created": data.get("creationInfo", {}).get("created"),
-                "creators": data.get("creationInfo", {}).get("creators", []),
-                "document_name": data.get("name")
-            },
-            "raw_data": data
+                "created": creation_info.get("created"),
+                "creators": creation_info.get("creators", []),
+                "document_name": document_name
+            }
         }
     
     @staticmethod
-    def parse_xml(root: ET.Element) -> Dict[str, Any]:
-        """SPDX XML形式を解析"""
+    def parse_xml(content: bytes) -> Dict[str, Any]:
+        """SPDX XML形式をiterparseでストリーム解析(簡易版)"""
         components = []
-        
-        # SPDX XML解析(簡易版)
-        for pkg in root.findall('.//Package'):
-            name_elem = pkg.find('name')
-            version_elem = pkg.find('versionInfo')
-            
-            component = Component(
-                name=name_elem.text if name_elem is not None else "unknown",
-                version=version_elem.text if version_elem is not None else "unknown",
+        root_attrib: Dict[str, str] = {}
+
+        context = etree.iterparse(BytesIO(content), events=('start', 'end'))
+        root_seen = False
+        for event, elem in context:
+            if event == 'start':
+                if not root_seen:
+                    root_attrib = dict(elem.attrib)
+                    root_seen = True
+                continue
+
+            if not isinstance(elem.tag, str) or etree.QName(elem).localname != 'Package':
+                continue
+
+            name = version = None
+            for child in elem:
+                if not isinstance(child.tag, str):
+                    continue
+                local = etree.QName(child).localname
+                if local == 'name':
+                    name = child.text
+                elif local == 'versionInfo':
+                    version = child.text
+
+            components.append(Component(
+                name=name or "unknown",
+                version=version or "unknown",
                 purl=None,
                 component_type="library"
-            )
-            components.append(component)
-        
+            ))
+
+            # 処理済みの要素と先行する兄弟を解放してメモリを抑える
+            parent = elem.getparent()
+            elem.clear()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+
         return {
             "format": "spdx",
-            "version": root.get("spdxVersion", "unknown"),
+            "version": root_attrib.get("spdxVersion", "unknown"),
             "components": components,
-            "metadata": {},
-            "raw_data": {}
+            "metadata": {}
         }
 
 
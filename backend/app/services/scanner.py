@@ -1,22 +1,207 @@
 """Vulnerability Scanner Service"""
+import orjson
+import os
 import re
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 import logging
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
-from app.models import Vulnerability, ScanResult, ScanVulnerability
+from app.models import Vulnerability, VulnerabilityProduct, ScanResult, ScanVulnerability
 from app.services.sbom_parser import Component
 from packaging import version as pkg_version
 
 logger = logging.getLogger(__name__)
 
+# 英数字以外の連続を1つの_にまとめる(正規化の2回のre.subを1回に統合)
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+# パースできないバージョン文字列を示す番兵
+# (失敗もキャッシュして毎回例外を投げ直さない)
+_INVALID_VERSION = object()
+
+
+def _cpe_vendor_product(criteria: str) -> Optional[Tuple[str, str]]:
+    """
+    CPE 2.3文字列からベンダー名と製品名を取り出す
+
+    split(':')のリスト割り当てを避け、固定プレフィックスの確認と
+    find(':')のオフセット計算だけで該当フィールドを切り出す。
+    形式が不正な場合はNone
+
+    Args:
+        criteria: "cpe:2.3:a:vendor:product:..." 形式の文字列
+
+    Returns:
+        (ベンダー名, 製品名)のタプル(小文字化済み)
+    """
+    # CPE 2.3は "cpe:2.3:<part>:" の固定プレフィックスで始まる
+    if not criteria.startswith('cpe:2.3:'):
+        return None
+    vendor_start = criteria.find(':', 8) + 1  # part(a/o/h)フィールドを飛ばす
+    if vendor_start == 0:
+        return None
+    vendor_end = criteria.find(':', vendor_start)
+    if vendor_end == -1:
+        return None
+    product_end = criteria.find(':', vendor_end + 1)
+    if product_end == -1:
+        product_end = len(criteria)
+    return (
+        criteria[vendor_start:vendor_end].lower(),
+        criteria[vendor_end + 1:product_end].lower()
+    )
+
+
+@lru_cache(maxsize=200_000)
+def _parse_ver(version_string: str):
+    """
+    packaging.Versionのパース結果をキャッシュ
+
+    pkg_version.parseは正規表現中心の重い処理で、同じバージョン文字列が
+    CPEレンジ境界として何度も現れるためメモ化の効果が大きい
+    """
+    try:
+        return pkg_version.parse(version_string)
+    except Exception:
+        return _INVALID_VERSION
+
+
+def _version_in_range(
+    comp_ver,
+    component_version: str,
+    version_start_including: Optional[str],
+    version_start_excluding: Optional[str],
+    version_end_including: Optional[str],
+    version_end_excluding: Optional[str]
+) -> bool:
+    """
+    コンポーネントのバージョンが脆弱性の影響範囲に含まれるか判定
+
+    モジュール関数にしてあるのは並列スキャンのワーカープロセスからも
+    呼べるようにするため
+
+    Args:
+        comp_ver: _parse_verでパース済みのコンポーネントバージョン
+        component_version: コンポーネントのバージョン(元の文字列)
+        version_start_including: 開始バージョン(含む)
+        version_start_excluding: 開始バージョン(含まない)
+        version_end_including: 終了バージョン(含む)
+        version_end_excluding: 終了バージョン(含まない)
+
+    Returns:
+        範囲に含まれる場合True
+    """
+    # パースに失敗した場合、文字列完全一致で判定
+    if comp_ver is _INVALID_VERSION:
+        return bool(version_start_including
+                    and component_version == version_start_including)
+
+    # 開始バージョンチェック
+    if version_start_including:
+        start_ver = _parse_ver(version_start_including)
+        if start_ver is _INVALID_VERSION:
+            return component_version == version_start_including
+        if comp_ver < start_ver:
+            return False
+
+    if version_start_excluding:
+        start_ver = _parse_ver(version_start_excluding)
+        if start_ver is _INVALID_VERSION:
+            return False
+        if comp_ver <= start_ver:
+            return False
+
+    # 終了バージョンチェック
+    if version_end_including:
+        end_ver = _parse_ver(version_end_including)
+        if end_ver is _INVALID_VERSION:
+            return False
+        if comp_ver > end_ver:
+            return False
+
+    if version_end_excluding:
+        end_ver = _parse_ver(version_end_excluding)
+        if end_ver is _INVALID_VERSION:
+            return False
+        if comp_ver >= end_ver:
+            return False
+
+    return True
+
+
+# ワーカープロセスに1回だけ渡すプレーンデータ版CPEインデックス
+# (initializer経由で共有し、タスクごとのpickleを避ける)
+_worker_cpe_index: Optional[Tuple[Dict[str, list], Dict[str, list]]] = None
+
+
+def _init_scan_worker(plain_index: Tuple[Dict[str, list], Dict[str, list]]):
+    """ProcessPoolExecutorのワーカー初期化(インデックスを受け取る)"""
+    global _worker_cpe_index
+    _worker_cpe_index = plain_index
+
+
+def _scan_component_chunk(
+    chunk: List[Tuple[int, str, str]]
+) -> List[Tuple[int, List[Tuple[int, Optional[str]]]]]:
+    """
+    コンポーネントのチャンクをワーカープロセス側で判定
+
+    Args:
+        chunk: (インデックス, 正規化済み名, バージョン)のリスト
+
+    Returns:
+        [(インデックス, [(脆弱性ID, マッチしたcriteria), ...]), ...]
+        (マッチのあったコンポーネントのみ)
+    """
+    product_index, vendor_index = _worker_cpe_index
+    results = []
+
+    for idx, normalized_name, version in chunk:
+        comp_ver = _parse_ver(version)
+        found: Dict[int, Optional[str]] = {}
+
+        for product, entries in product_index.items():
+            if product in normalized_name or normalized_name in product:
+                _collect_plain_matches(comp_ver, version, entries, found)
+        for vendor, entries in vendor_index.items():
+            if vendor in normalized_name:
+                _collect_plain_matches(comp_ver, version, entries, found)
+
+        if found:
+            results.append((idx, list(found.items())))
+
+    return results
+
+
+def _collect_plain_matches(
+    comp_ver,
+    version: str,
+    entries: list,
+    found: Dict[int, Optional[str]]
+) -> None:
+    """プレーンデータ版エントリにバージョン範囲の判定を適用"""
+    for vuln_id, criteria, si, sx, ei, ex in entries:
+        if vuln_id in found:
+            continue
+        if _version_in_range(comp_ver, version, si, sx, ei, ex):
+            found[vuln_id] = criteria
+
 
 class VulnerabilityScanner:
     """脆弱性スキャンサービス"""
-    
+
+    # これを超えるコンポーネント数でプロセスプールに分散する
+    # (小規模スキャンではプロセス起動コストの方が高くつく)
+    PARALLEL_SCAN_THRESHOLD = 500
+
     def __init__(self, db: Session):
         self.db = db
+        # スキャン中にマッチしたCPE criteriaのキャッシュ(脆弱性ID→criteria)
+        # 保存時にcpe_match JSONを再パースしないため
+        self._matched_cpe_cache: Dict[int, Optional[str]] = {}
     
     def scan_components(self, components: List[Component]) -> Dict[str, Any]:
         """
@@ -29,140 +214,331 @@ class VulnerabilityScanner:
             スキャン結果の統計情報
         """
         logger.info(f"Starting vulnerability scan for {len(components)} components")
-        
+
+        # まずvulnerability_productsのインデックス付き検索で候補を絞り込み、
+        # 絞り込んだ脆弱性だけを逆引きインデックス化する
+        # (コンポーネントごとの全件クエリ + JSON再パースを排除)
+        candidate_ids = self._prefilter_candidate_ids(components)
+        cpe_index = self._build_cpe_index(candidate_ids)
+
         results = {
             'total_components': len(components),
             'vulnerable_components': [],
-            'vulnerabilities_found': [],
-            'severity_counts': {
-                'CRITICAL': 0,
-                'HIGH': 0,
-                'MEDIUM': 0,
-                'LOW': 0,
-                'UNKNOWN': 0
-            }
+            'vulnerabilities_found': []
         }
-        
-        for component in components:
-            vulnerabilities = self._find_vulnerabilities_for_component(component)
-            
+        # CounterのC実装update()で深刻度を集計する
+        # (1件ごとのget+代入の2回の辞書操作を省く)
+        sev_counter = Counter(
+            {'CRITICAL': 0, 'HIGH': 0, 'MEDIUM': 0, 'LOW': 0, 'UNKNOWN': 0}
+        )
+
+        matches = self._match_components(components, cpe_index)
+
+        for component, vulnerabilities in zip(components, matches):
             if vulnerabilities:
                 results['vulnerable_components'].append({
                     'component': component,
                     'vulnerabilities': vulnerabilities
                 })
-                
-                for vuln in vulnerabilities:
-                    results['vulnerabilities_found'].append(vuln)
-                    severity = vuln.severity or 'UNKNOWN'
-                    results['severity_counts'][severity] = results['severity_counts'].get(severity, 0) + 1
-        
+                results['vulnerabilities_found'].extend(vulnerabilities)
+                sev_counter.update(
+                    vuln.severity or 'UNKNOWN' for vuln in vulnerabilities
+                )
+
+        results['severity_counts'] = dict(sev_counter)
+
         logger.info(f"Scan completed: {len(results['vulnerable_components'])} vulnerable components found")
         return results
     
-    def _find_vulnerabilities_for_component(
-        self, 
-        component: Component
-    ) -> List[Vulnerability]:
+    def _match_components(
+        self,
+        components: List[Component],
+        cpe_index: Tuple[Dict[str, list], Dict[str, list]]
+    ) -> List[List[Vulnerability]]:
         """
-        特定のコンポーネントに対する脆弱性を検索
-        
-        Args:
-            component: スキャン対象のコンポーネント
-            
+        全コンポーネントの名前/バージョン判定を実行
+
+        インデックス構築後の判定は読み取り専用でCPUバウンドのため、
+        コンポーネント数が閾値を超えたらプロセスプールに分散する。
+        並列化に失敗した場合(デーモンプロセス内等)は直列にフォールバック
+
         Returns:
-            該当する脆弱性のリスト
+            componentsと同じ順序の、コンポーネントごとの脆弱性リスト
         """
-        vulnerabilities = []
-        
-        # コンポーネント名を正規化
-        normalized_name = self._normalize_component_name(component.name)
-        
-        # データベースから関連しそうな脆弱性を取得
-        # CPEマッチを使って検索
-        candidates = self.db.query(Vulnerability).filter(
-            Vulnerability.cpe_match.isnot(None)
-        ).all()
-        
-        for vuln in candidates:
-            if self._is_vulnerable(component, vuln):
-                vulnerabilities.append(vuln)
-        
-        return vulnerabilities
-    
-    def _is_vulnerable(self, component: Component, vulnerability: Vulnerability) -> bool:
+        if (len(components) > self.PARALLEL_SCAN_THRESHOLD
+                and (os.cpu_count() or 1) > 1):
+            try:
+                id_matches = self._scan_parallel(components, cpe_index)
+            except Exception as e:
+                logger.warning(
+                    f"Parallel scan unavailable, falling back to serial: {str(e)}"
+                )
+                id_matches = None
+        else:
+            id_matches = None
+
+        if id_matches is None:
+            id_matches = [
+                self._find_vulnerabilities_for_component(component, cpe_index)
+                for component in components
+            ]
+
+        # マッチした脆弱性だけを1回のクエリで完全な行としてロードする
+        # (インデックスにはID+cpe_matchしか持たないため)
+        matched_ids = {
+            vuln_id for found in id_matches for vuln_id in found
+        }
+        vuln_map: Dict[int, Vulnerability] = {}
+        if matched_ids:
+            vuln_map = {
+                vuln.id: vuln
+                for vuln in self.db.query(Vulnerability).filter(
+                    Vulnerability.id.in_(matched_ids)
+                )
+            }
+
+        matches: List[List[Vulnerability]] = []
+        for found in id_matches:
+            matches.append([vuln_map[vuln_id] for vuln_id in found])
+            for vuln_id, criteria in found.items():
+                self._matched_cpe_cache.setdefault(vuln_id, criteria)
+        return matches
+
+    def _scan_parallel(
+        self,
+        components: List[Component],
+        cpe_index: Tuple[Dict[str, list], Dict[str, list]]
+    ) -> List[Dict[int, Optional[str]]]:
         """
-        コンポーネントが脆弱性の影響を受けるか判定
-        
+        コンポーネント判定をプロセスプールに分散
+
+        インデックスを(脆弱性ID, criteria, バージョン境界)のプレーンな
+        タプルに変換し、initializer経由で各ワーカーに1回だけ渡す。
+        ワーカーはIDとcriteriaだけを返す
+        """
+        product_index, vendor_index = cpe_index
+
+        def to_plain(index: Dict[str, list]) -> Dict[str, list]:
+            plain: Dict[str, list] = {}
+            for key, entries in index.items():
+                plain[key] = [
+                    (
+                        vuln_id,
+                        cpe_match.get('criteria'),
+                        cpe_match.get('versionStartIncluding'),
+                        cpe_match.get('versionStartExcluding'),
+                        cpe_match.get('versionEndIncluding'),
+                        cpe_match.get('versionEndExcluding')
+                    )
+                    for vuln_id, cpe_match in entries
+                ]
+            return plain
+
+        plain_index = (to_plain(product_index), to_plain(vendor_index))
+
+        tasks = [
+            (idx, self._normalize_component_name(component.name), component.version)
+            for idx, component in enumerate(components)
+        ]
+        workers = os.cpu_count() or 1
+        chunk_size = -(-len(tasks) // workers)  # 切り上げ除算
+        chunks = [
+            tasks[offset:offset + chunk_size]
+            for offset in range(0, len(tasks), chunk_size)
+        ]
+
+        id_matches: List[Dict[int, Optional[str]]] = [{} for _ in components]
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_scan_worker,
+            initargs=(plain_index,)
+        ) as pool:
+            for chunk_result in pool.map(_scan_component_chunk, chunks):
+                for idx, found in chunk_result:
+                    id_matches[idx] = dict(found)
+
+        logger.info(f"Parallel scan completed across {len(chunks)} worker chunks")
+        return id_matches
+
+    def _prefilter_candidate_ids(self, components: List[Component]) -> List[int]:
+        """
+        vulnerability_productsテーブルで候補の脆弱性IDを絞り込む
+
+        完全一致(最頻のケース)だけをIN句でSQL側に任せる — これは
+        移行008のbtreeインデックスが効く。部分一致の判定は
+        (vulnerability_id, product, vendor)の細い射影をサーバーサイド
+        カーソルで流しながらPython側で行う。strposのOR連結をSQLに
+        埋め込むとインデックスが一切効かず、行数×コンポーネント数の
+        substring評価を1つの巨大なステートメントで払うことになる
+
+        部分一致の判定は_find_vulnerabilities_for_componentと同じで、
+        製品名は双方向、ベンダー名は一方向:
+        - name_pattern.search(product): いずれかの名前が製品名の部分文字列
+        - product in names_blob: 製品名がいずれかの名前の部分文字列
+          (改行区切りの連結なので境界をまたぐ誤検知はない)
+
+        Returns:
+            名前がマッチする可能性のある脆弱性IDのリスト
+        """
+        names = {
+            self._normalize_component_name(component.name)
+            for component in components if component.name
+        }
+        names.discard('')
+        if not names:
+            return []
+
+        candidate_ids = {
+            row[0] for row in
+            self.db.query(VulnerabilityProduct.vulnerability_id)
+            .filter(VulnerabilityProduct.product.in_(names))
+            .distinct()
+        }
+
+        names_blob = "\n" + "\n".join(names) + "\n"
+        name_pattern = re.compile(
+            "|".join(re.escape(name) for name in names)
+        )
+
+        rows = self.db.query(
+            VulnerabilityProduct.vulnerability_id,
+            VulnerabilityProduct.product,
+            VulnerabilityProduct.vendor
+        ).execution_options(stream_results=True).yield_per(5000)
+
+        for vuln_id, product, vendor in rows:
+            if vuln_id in candidate_ids or not product:
+                continue
+            if (product in names_blob
+                    or name_pattern.search(product) is not None
+                    or (vendor and vendor in names_blob)):
+                candidate_ids.add(vuln_id)
+
+        return list(candidate_ids)
+
+    def _build_cpe_index(
+        self, candidate_ids: List[int]
+    ) -> Tuple[Dict[str, list], Dict[str, list]]:
+        """
+        CPE製品名/ベンダー名→(脆弱性ID, CPEエントリ)の逆引きインデックスを構築
+
+        SQLで絞り込んだ候補のIDとcpe_matchだけをサーバーサイドカーソルで
+        読む(descriptionやreferences等の大きいカラムはロードしない)。
+        完全なVulnerability行は、実際にマッチしたものだけを後でまとめて取得する
+
         Args:
-            component: コンポーネント
-            vulnerability: 脆弱性
-            
+            candidate_ids: _prefilter_candidate_idsが絞り込んだ脆弱性ID
+
         Returns:
-            影響を受ける場合True
+            (製品名インデックス, ベンダー名インデックス)のタプル
         """
-        if not vulnerability.cpe_match:
-            return False
-        
-        cpe_matches = vulnerability.cpe_match
-        if isinstance(cpe_matches, str):
-            import json
-            try:
-                cpe_matches = json.loads(cpe_matches)
-            except:
-                return False
-        
-        normalized_name = self._normalize_component_name(component.name)
-        
-        for cpe_match in cpe_matches:
-            criteria = cpe_match.get('criteria', '')
-            
-            # CPE文字列から製品名を抽出
-            # 形式: cpe:2.3:a:vendor:product:version:...
-            if self._match_cpe_product(criteria, normalized_name):
-                # バージョンチェック
-                if self._check_version_range(
-                    component.version,
-                    cpe_match.get('versionStartIncluding'),
-                    cpe_match.get('versionStartExcluding'),
-                    cpe_match.get('versionEndIncluding'),
-                    cpe_match.get('versionEndExcluding')
-                ):
-                    return True
-        
-        return False
-    
-    def _match_cpe_product(self, cpe: str, component_name: str) -> bool:
+        product_index: Dict[str, list] = defaultdict(list)
+        vendor_index: Dict[str, list] = defaultdict(list)
+
+        if not candidate_ids:
+            return product_index, vendor_index
+
+        candidates = self.db.query(
+            Vulnerability.id, Vulnerability.cpe_match
+        ).filter(
+            Vulnerability.id.in_(candidate_ids),
+            Vulnerability.cpe_match.isnot(None)
+        ).execution_options(stream_results=True).yield_per(2000)
+
+        for vuln_id, cpe_matches in candidates:
+            if isinstance(cpe_matches, str):
+                try:
+                    cpe_matches = orjson.loads(cpe_matches)
+                except orjson.JSONDecodeError:
+                    continue
+
+            for cpe_match in cpe_matches:
+                # 取り込み時に分解済みのフィールドを優先し、
+                # 旧形式のエントリのみcriteriaをその場で分解する
+                product = cpe_match.get('product')
+                if product is not None:
+                    vendor = cpe_match.get('vendor') or ''
+                else:
+                    vendor_product = _cpe_vendor_product(cpe_match.get('criteria', ''))
+                    if vendor_product is None:
+                        continue
+                    vendor, product = vendor_product
+                entry = (vuln_id, cpe_match)
+                product_index[product].append(entry)
+                if vendor:
+                    vendor_index[vendor].append(entry)
+
+        logger.info(
+            f"CPE index built: {len(product_index)} products, "
+            f"{len(vendor_index)} vendors"
+        )
+        return product_index, vendor_index
+
+    def _find_vulnerabilities_for_component(
+        self,
+        component: Component,
+        cpe_index: Tuple[Dict[str, list], Dict[str, list]]
+    ) -> Dict[int, Optional[str]]:
         """
-        CPE文字列とコンポーネント名がマッチするか判定
-        
+        特定のコンポーネントに対する脆弱性を検索
+
+        逆引きインデックスのキー(製品名/ベンダー名の異なり数)だけを
+        走査するため、脆弱性全件×CPEエントリの線形スキャンは発生しない
+
         Args:
-            cpe: CPE文字列
-            component_name: 正規化されたコンポーネント名
-            
+            component: スキャン対象のコンポーネント
+            cpe_index: _build_cpe_indexが構築したインデックス
+
         Returns:
-            マッチする場合True
+            脆弱性ID→マッチしたcriteriaの辞書
         """
-        # CPE形式: cpe:2.3:a:vendor:product:version:...
-        parts = cpe.split(':')
-        if len(parts) < 5:
-            return False
-        
-        product = parts[4].lower()
-        vendor = parts[3].lower() if len(parts) > 3 else ""
-        
-        # 製品名の比較
-        if product in component_name or component_name in product:
-            return True
-        
+        product_index, vendor_index = cpe_index
+
+        # コンポーネント名を正規化
+        normalized_name = self._normalize_component_name(component.name)
+
+        matched: Dict[int, Optional[str]] = {}
+
+        # コンポーネントのバージョンは1回だけパースして使い回す
+        comp_ver = _parse_ver(component.version)
+
+        # 製品名の比較(部分一致は双方向)
+        for product, entries in product_index.items():
+            if product in normalized_name or normalized_name in product:
+                self._collect_version_matches(component, comp_ver, entries, matched)
+
         # ベンダー名も含めて比較
-        if vendor and (vendor in component_name or f"{vendor}_{product}" in component_name):
-            return True
-        
-        return False
-    
+        for vendor, entries in vendor_index.items():
+            if vendor in normalized_name:
+                self._collect_version_matches(component, comp_ver, entries, matched)
+
+        return matched
+
+    def _collect_version_matches(
+        self,
+        component: Component,
+        comp_ver,
+        entries: list,
+        matched: Dict[int, Optional[str]]
+    ) -> None:
+        """名前がマッチしたエントリにバージョン範囲の判定を適用"""
+        for vuln_id, cpe_match in entries:
+            if vuln_id in matched:
+                continue
+            if self._check_version_range(
+                comp_ver,
+                component.version,
+                cpe_match.get('versionStartIncluding'),
+                cpe_match.get('versionStartExcluding'),
+                cpe_match.get('versionEndIncluding'),
+                cpe_match.get('versionEndExcluding')
+            ):
+                matched[vuln_id] = cpe_match.get('criteria')
+
+
     def _check_version_range(
         self,
+        comp_ver,
         component_version: str,
         version_start_including: Optional[str],
         version_start_excluding: Optional[str],
@@ -171,70 +547,43 @@ class VulnerabilityScanner:
     ) -> bool:
         """
         コンポーネントのバージョンが脆弱性の影響範囲に含まれるか判定
-        
+
         Args:
-            component_version: コンポーネントのバージョン
+            comp_ver: _parse_verでパース済みのコンポーネントバージョン
+            component_version: コンポーネントのバージョン(元の文字列)
             version_start_including: 開始バージョン(含む)
             version_start_excluding: 開始バージョン(含まない)
             version_end_including: 終了バージョン(含む)
             version_end_excluding: 終了バージョン(含まない)
-            
+
         Returns:
             範囲に含まれる場合True
         """
-        try:
-            comp_ver = pkg_version.parse(component_version)
-            
-            # 開始バージョンチェック
-            if version_start_including:
-                start_ver = pkg_version.parse(version_start_including)
-                if comp_ver < start_ver:
-                    return False
-            
-            if version_start_excluding:
-                start_ver = pkg_version.parse(version_start_excluding)
-                if comp_ver <= start_ver:
-                    return False
-            
-            # 終了バージョンチェック
-            if version_end_including:
-                end_ver = pkg_version.parse(version_end_including)
-                if comp_ver > end_ver:
-                    return False
-            
-            if version_end_excluding:
-                end_ver = pkg_version.parse(version_end_excluding)
-                if comp_ver >= end_ver:
-                    return False
-            
-            return True
-            
-        except Exception as e:
-            logger.warning(f"Version comparison failed: {component_version} - {str(e)}")
-            # バージョン比較に失敗した場合、文字列完全一致で判定
-            if version_start_including and component_version == version_start_including:
-                return True
-            return False
+        return _version_in_range(
+            comp_ver,
+            component_version,
+            version_start_including,
+            version_start_excluding,
+            version_end_including,
+            version_end_excluding
+        )
     
-    def _normalize_component_name(self, name: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=10_000)
+    def _normalize_component_name(name: str) -> str:
         """
         コンポーネント名を正規化(小文字、記号除去)
-        
+
+        同じ名前が繰り返し正規化されるためlru_cacheでメモ化する
+
         Args:
             name: コンポーネント名
-            
+
         Returns:
             正規化された名前
         """
-        # 小文字に変換
-        normalized = name.lower()
-        # 記号を_に置換
-        normalized = re.sub(r'[^a-z0-9]', '_', normalized)
-        # 連続するアンダースコアを1つに
-        normalized = re.sub(r'_+', '_', normalized)
-        # 前後のアンダースコアを削除
-        normalized = normalized.strip('_')
-        return normalized
+        # 小文字化し、記号の連続を_1つに置換、前後の_を削除
+        return _NON_ALNUM.sub('_', name.lower()).strip('_')
     
     def save_scan_result(
         self,
@@ -270,20 +619,23 @@ class VulnerabilityScanner:
             
             self.db.add(scan_result)
             self.db.flush()  # IDを取得
-            
-            # ScanVulnerabilityの作成
+
+            # ScanVulnerabilityは1行ずつadd()せず一括INSERTする
+            # (数千件のORM INSERTはオーバーヘッドが支配的になる)
+            rows = []
             for vuln_comp in scan_results['vulnerable_components']:
                 component = vuln_comp['component']
                 for vulnerability in vuln_comp['vulnerabilities']:
-                    scan_vuln = ScanVulnerability(
-                        scan_result_id=scan_result.id,
-                        vulnerability_id=vulnerability.id,
-                        component_name=component.name,
-                        component_version=component.version,
-                        matched_cpe=self._extract_matched_cpe(component, vulnerability)
-                    )
-                    self.db.add(scan_vuln)
-            
+                    rows.append({
+                        'scan_result_id': scan_result.id,
+                        'vulnerability_id': vulnerability.id,
+                        'component_name': component.name,
+                        'component_version': component.version,
+                        'matched_cpe': self._extract_matched_cpe(component, vulnerability)
+                    })
+            if rows:
+                self.db.bulk_insert_mappings(ScanVulnerability, rows)
+
             self.db.commit()
             logger.info(f"Scan result saved: ID={scan_result.id}")
             return scan_result
@@ -296,23 +648,28 @@ class VulnerabilityScanner:
     def _extract_matched_cpe(self, component: Component, vulnerability: Vulnerability) -> Optional[str]:
         """
         マッチしたCPE文字列を取得
-        
+
+        スキャン中に記録したcriteriaがあればそれを返し、
+        cpe_match JSONの再パースを避ける
+
         Args:
             component: コンポーネント
             vulnerability: 脆弱性
-            
+
         Returns:
             CPE文字列
         """
+        if vulnerability.id in self._matched_cpe_cache:
+            return self._matched_cpe_cache[vulnerability.id]
+
         if not vulnerability.cpe_match:
             return None
         
         cpe_matches = vulnerability.cpe_match
         if isinstance(cpe_matches, str):
-            import json
             try:
-                cpe_matches = json.loads(cpe_matches)
-            except:
+                cpe_matches = orjson.loads(cpe_matches)
+            except orjson.JSONDecodeError:
                 return None
         
         for cpe_match in cpe_matches:
@@ -1,22 +1,58 @@
 """Trivy Scanner Service"""
-import json
+import asyncio
+import hashlib
+import orjson
+import pandas as pd
+import shutil
 import subprocess
+
+try:
+    # C実装バックエンド(yajl2)があればそちらを使う
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
 import tempfile
+import threading
+import time
 import os
-from typing import Dict, Any, List, Optional
+from collections import Counter
+from typing import Dict, Any, Iterator, List, Optional
 from datetime import datetime
 import logging
 from pathlib import Path
+from app.redis_client import redis_client
 
 logger = logging.getLogger(__name__)
 
+# スキャン結果キャッシュのTTL。キーにTrivy DBの版が入るため
+# DB更新後の古いエントリは参照されず、TTLで自然に消える
+SCAN_CACHE_TTL_SECONDS = 86400
+
+
+def _iso_now() -> str:
+    """現在時刻のISO文字列(レスポンス組み立てで1回だけ呼んで使い回す)"""
+    return datetime.utcnow().isoformat()
+
 
 class TrivyService:
     """Trivyを使用した脆弱性スキャンサービス"""
-    
+
+    # 同時に走らせるTrivyプロセス数の上限(async経路)
+    MAX_CONCURRENT_SCANS = 4
+
     def __init__(self):
         self.trivy_cache_dir = os.getenv("TRIVY_CACHE_DIR", str(Path.home() / ".cache" / "trivy"))
-        self.trivy_command = "trivy"
+        # 絶対パスに解決しておき、スキャンごとのexecvpのPATH探索を省く。
+        # 見つからなくても例外にはせず素のコマンド名に戻す
+        # (インストール状態はcheck_trivy_installedで判定する)
+        trivy_bin = os.getenv("TRIVY_BIN", "trivy")
+        resolved = shutil.which(trivy_bin)
+        if resolved is None:
+            logger.warning("'%s' not found on PATH, scans will fail until installed", trivy_bin)
+        self.trivy_command = resolved or trivy_bin
+        self.scan_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_SCANS)
+        # check_trivy_installed()のメモ(プロセス内で変わらない前提)
+        self._installed: Optional[bool] = None
     
     def update_database(self) -> Dict[str, Any]:
         """
@@ -38,32 +74,32 @@ class TrivyService:
                 "alpine:latest"  # ダミーイメージ
             ]
             
-            logger.info(f"Executing: {' '.join(cmd)}")
+            logger.info("Executing: %s", cmd)
             
+            # bytesのまま受け取り、ログに出すときだけデコードする
             result = subprocess.run(
                 cmd,
                 capture_output=True,
-                text=True,
                 timeout=600  # 10分タイムアウト
             )
-            
+
             if result.returncode == 0:
                 logger.info("Trivy database update completed successfully")
-                logger.info(f"Output: {result.stdout}")
-                
+                logger.info("Output: %s", result.stdout.decode(errors='replace'))
+
                 return {
                     "status": "success",
-                    "updated_at": datetime.utcnow().isoformat(),
+                    "updated_at": _iso_now(),
                     "cache_dir": self.trivy_cache_dir,
                     "message": "Database updated successfully"
                 }
             else:
-                error_msg = f"Trivy DB update failed: {result.stderr}"
+                error_msg = f"Trivy DB update failed: {result.stderr.decode(errors='replace')}"
                 logger.error(error_msg)
                 return {
                     "status": "failed",
                     "error": error_msg,
-                    "updated_at": datetime.utcnow().isoformat()
+                    "updated_at": _iso_now()
                 }
                 
         except subprocess.TimeoutExpired:
@@ -72,7 +108,7 @@ class TrivyService:
             return {
                 "status": "failed",
                 "error": error_msg,
-                "updated_at": datetime.utcnow().isoformat()
+                "updated_at": _iso_now()
             }
         except Exception as e:
             error_msg = f"Trivy DB update error: {str(e)}"
@@ -80,189 +116,836 @@ class TrivyService:
             return {
                 "status": "failed",
                 "error": error_msg,
-                "updated_at": datetime.utcnow().isoformat()
+                "updated_at": _iso_now()
             }
     
-    def scan_sbom(self, sbom_content: Dict[str, Any], sbom_format: str = "cyclonedx") -> Dict[str, Any]:
+    def scan_sbom(self, sbom_content: Optional[Dict[str, Any]] = None,
+                  sbom_format: str = "cyclonedx",
+                  sbom_raw: Optional[bytes] = None,
+                  detail: str = "full") -> Dict[str, Any]:
         """
         SBOMファイルをTrivyでスキャン
-        
+
         Args:
-            sbom_content: SBOMのJSON内容
+            sbom_content: SBOMのJSON内容(dict)
             sbom_format: SBOMフォーマット ('cyclonedx' or 'spdx')
-            
+            sbom_raw: SBOMのJSONバイト列。指定された場合はdictへの
+                デシリアライズ/再シリアライズを介さずそのままTrivyに渡す
+            detail: 'full'で全脆弱性の詳細を返す。集計値だけで足りる
+                呼び出し(ダッシュボード等)は'summary'で行変換を省略できる
+
         Returns:
             スキャン結果
         """
-        logger.info(f"Starting Trivy SBOM scan (format: {sbom_format})...")
-        
+        logger.info("Starting Trivy SBOM scan (format: %s)...", sbom_format)
+
         try:
-            # 一時ファイルにSBOMを保存
-            with tempfile.NamedTemporaryFile(
-                mode='w',
-                suffix='.json',
-                delete=False,
-                encoding='utf-8'
-            ) as temp_file:
-                json.dump(sbom_content, temp_file, indent=2)
-                temp_path = temp_file.name
-            
+            payload = self._sbom_payload(sbom_content, sbom_raw)
+
+            # 同一SBOM+同一Trivy DBの再スキャンはキャッシュから返す
+            cache_key = self._scan_cache_key(payload, detail)
+            cached = self._cached_scan_result(cache_key)
+            if cached is not None:
+                logger.info("Trivy scan cache hit, skipping scan")
+                return cached
+
+            # Trivyはフォーマット自動判定で入力をシークするため、
+            # パイプ(/dev/stdin)は渡せない — シーク可能な一時ファイル経由
+            temp_path = self._write_sbom_temp(payload)
             try:
-                # Trivyスキャンコマンドを実行
+                cmd = self._build_scan_cmd(temp_path)
+                logger.info("Executing: %s", cmd)
+                parsed_result = self._run_scan_streaming(cmd, detail=detail)
+            finally:
+                # 一時ファイルを削除
+                self._unlink_quiet(temp_path)
+
+            self._store_scan_result(cache_key, parsed_result)
+            return parsed_result
+
+        except subprocess.TimeoutExpired:
+            error_msg = "Trivy scan timed out"
+            logger.error(error_msg)
+            return self._failed_scan_result(error_msg)
+        except Exception as e:
+            error_msg = f"Trivy scan error: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            return self._failed_scan_result(error_msg)
+
+    async def scan_sbom_async(self, sbom_content: Optional[Dict[str, Any]] = None,
+                              sbom_format: str = "cyclonedx",
+                              sbom_raw: Optional[bytes] = None,
+                              detail: str = "full") -> Dict[str, Any]:
+        """
+        SBOMファイルをTrivyでスキャン(async版)
+
+        subprocess.runの代わりにasyncio.create_subprocess_execを使い、
+        Trivyの実行中にイベントループをブロックしない。同時実行数は
+        scan_semaphoreで制限する。Celery(gevent)のワーカーは同期版の
+        scan_sbomを使い続ける — gevent配下でのasyncio.runは避ける
+
+        Args:
+            sbom_content: SBOMのJSON内容(dict)
+            sbom_format: SBOMフォーマット ('cyclonedx' or 'spdx')
+            sbom_raw: SBOMのJSONバイト列(指定時はそのままTrivyに渡す)
+            detail: 'full'で全脆弱性の詳細、'summary'で集計値のみ
+
+        Returns:
+            スキャン結果
+        """
+        logger.info("Starting async Trivy SBOM scan (format: %s)...", sbom_format)
+
+        temp_path = None
+        try:
+            payload = self._sbom_payload(sbom_content, sbom_raw)
+
+            # 同一SBOM+同一Trivy DBの再スキャンはキャッシュから返す
+            cache_key = self._scan_cache_key(payload, detail)
+            cached = self._cached_scan_result(cache_key)
+            if cached is not None:
+                logger.info("Trivy scan cache hit, skipping scan")
+                return cached
+
+            # Trivyはフォーマット自動判定で入力をシークするため、
+            # パイプは渡せない — シーク可能な一時ファイル経由
+            # (ファイル書き込みはスレッドに逃がす)
+            temp_path = await asyncio.to_thread(self._write_sbom_temp, payload)
+            cmd = self._build_scan_cmd(temp_path)
+
+            logger.info("Executing: %s", cmd)
+
+            try:
+                async with self.scan_semaphore:
+                    proc = await asyncio.create_subprocess_exec(
+                        *cmd,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE
+                    )
+                    try:
+                        stdout, stderr = await asyncio.wait_for(
+                            proc.communicate(), timeout=300
+                        )
+                    except asyncio.TimeoutError:
+                        proc.kill()
+                        await proc.wait()
+                        raise
+
+                parsed_result = self._handle_scan_output(
+                    proc.returncode, stdout, stderr, detail=detail
+                )
+                self._store_scan_result(cache_key, parsed_result)
+                return parsed_result
+
+            finally:
+                if temp_path:
+                    self._unlink_quiet(temp_path)
+
+        except asyncio.TimeoutError:
+            error_msg = "Trivy scan timed out"
+            logger.error(error_msg)
+            return self._failed_scan_result(error_msg)
+        except Exception as e:
+            error_msg = f"Trivy scan error: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            return self._failed_scan_result(error_msg)
+
+    def scan_sbom_batch(self, sboms: List[Dict[str, Any]],
+                        sbom_format: str = "cyclonedx") -> List[Dict[str, Any]]:
+        """
+        複数のSBOMを1回のTrivy起動でまとめてスキャン
+
+        SBOMごとにscan_sbomを呼ぶとプロセス起動+DBオープンの
+        オーバーヘッド(数百ms)をN回払う。ここでは全SBOMを一時
+        ディレクトリに書き出し、trivy fs(SBOMファイルを拡張子で
+        自動検出する)を1回だけ実行して、結果をTargetのファイル名で
+        SBOMごとに振り分ける。
+        注: trivy sbomはファイル1つしか受け取れないため、ディレクトリ
+        スキャンにはfsサブコマンドを使う
+
+        Args:
+            sboms: SBOMのJSON内容(dict)のリスト
+            sbom_format: SBOMフォーマット ('cyclonedx' or 'spdx')
+
+        Returns:
+            入力と同じ順序のスキャン結果リスト
+        """
+        if not sboms:
+            return []
+
+        logger.info("Starting Trivy batch scan of %d SBOMs...", len(sboms))
+
+        # trivy fsのSBOM自動検出はこの拡張子を前提とする
+        suffix = ".cdx.json" if sbom_format == "cyclonedx" else ".spdx.json"
+
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                for i, sbom in enumerate(sboms):
+                    with open(os.path.join(tmpdir, f"{i}{suffix}"), 'wb') as f:
+                        f.write(orjson.dumps(sbom))
+
                 cmd = [
                     self.trivy_command,
-                    "sbom",
+                    "fs",
                     "--format", "json",
                     "--cache-dir", self.trivy_cache_dir,
                     "--severity", "UNKNOWN,LOW,MEDIUM,HIGH,CRITICAL",
-                    temp_path
+                    "--scanners", "vuln",
+                    "--quiet",
+                    "--skip-db-update",
+                    "--offline-scan",
+                    tmpdir
                 ]
-                
-                logger.info(f"Executing: {' '.join(cmd)}")
-                
+                logger.info("Executing: %s", cmd)
                 result = subprocess.run(
                     cmd,
                     capture_output=True,
-                    text=True,
-                    timeout=300  # 5分タイムアウト
+                    timeout=600  # バッチなので単体スキャンより長めに取る
                 )
-                
-                if result.returncode == 0 or result.returncode == 1:
-                    # returncode 1 = 脆弱性が見つかった場合（正常）
-                    logger.info("Trivy scan completed")
-                    
-                    # 結果をパース
-                    scan_result = json.loads(result.stdout)
-                    parsed_result = self._parse_trivy_result(scan_result)
-                    
-                    logger.info(f"Found {len(parsed_result['vulnerabilities'])} vulnerabilities")
-                    return parsed_result
-                else:
-                    error_msg = f"Trivy scan failed: {result.stderr}"
-                    logger.error(error_msg)
-                    return {
-                        "status": "failed",
-                        "error": error_msg,
-                        "vulnerabilities": [],
-                        "severity_counts": {
-                            "CRITICAL": 0,
-                            "HIGH": 0,
-                            "MEDIUM": 0,
-                            "LOW": 0,
-                            "UNKNOWN": 0
-                        }
-                    }
-                    
-            finally:
-                # 一時ファイルを削除
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-                    
+
+            if result.returncode not in (0, 1):
+                error_msg = f"Trivy batch scan failed: {result.stderr.decode(errors='replace')}"
+                logger.error(error_msg)
+                return [self._failed_scan_result(error_msg) for _ in sboms]
+
+            # Results[].Targetのファイル名({i}.cdx.json)で元のSBOMに振り分ける
+            raw = orjson.loads(result.stdout)
+            grouped: List[List[Dict[str, Any]]] = [[] for _ in sboms]
+            for res in raw.get("Results", []):
+                stem = os.path.basename(res.get("Target", "")).split(".", 1)[0]
+                if stem.isdigit() and int(stem) < len(sboms):
+                    grouped[int(stem)].append(res)
+
+            return [
+                self._parse_trivy_result({"Results": results})
+                for results in grouped
+            ]
+
         except subprocess.TimeoutExpired:
-            error_msg = "Trivy scan timed out"
+            error_msg = "Trivy batch scan timed out"
+            logger.error(error_msg)
+            return [self._failed_scan_result(error_msg) for _ in sboms]
+        except Exception as e:
+            error_msg = f"Trivy batch scan error: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            return [self._failed_scan_result(error_msg) for _ in sboms]
+
+    async def update_database_async(self) -> Dict[str, Any]:
+        """
+        Trivyの脆弱性データベースを更新(async版)
+
+        Returns:
+            更新結果の統計情報
+        """
+        logger.info("Starting async Trivy database update...")
+
+        cmd = [
+            self.trivy_command,
+            "image",
+            "--download-db-only",
+            "--cache-dir", self.trivy_cache_dir,
+            "alpine:latest"  # ダミーイメージ
+        ]
+        logger.info("Executing: %s", cmd)
+
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(), timeout=600
+                )
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise
+
+            if proc.returncode == 0:
+                logger.info("Trivy database update completed successfully")
+                logger.info("Output: %s", stdout.decode(errors='replace'))
+                return {
+                    "status": "success",
+                    "updated_at": _iso_now(),
+                    "cache_dir": self.trivy_cache_dir,
+                    "message": "Database updated successfully"
+                }
+            else:
+                error_msg = f"Trivy DB update failed: {stderr.decode(errors='replace')}"
+                logger.error(error_msg)
+                return {
+                    "status": "failed",
+                    "error": error_msg,
+                    "updated_at": _iso_now()
+                }
+
+        except asyncio.TimeoutError:
+            error_msg = "Trivy DB update timed out"
             logger.error(error_msg)
             return {
                 "status": "failed",
                 "error": error_msg,
-                "vulnerabilities": [],
-                "severity_counts": {"CRITICAL": 0, "HIGH": 0, "MEDIUM": 0, "LOW": 0, "UNKNOWN": 0}
+                "updated_at": _iso_now()
             }
         except Exception as e:
-            error_msg = f"Trivy scan error: {str(e)}"
+            error_msg = f"Trivy DB update error: {str(e)}"
             logger.error(error_msg, exc_info=True)
             return {
                 "status": "failed",
                 "error": error_msg,
+                "updated_at": _iso_now()
+            }
+
+    def _trivy_db_version(self) -> str:
+        """
+        TrivyローカルDBの版識別子を返す
+
+        metadata.jsonのVersionとmtimeを組み合わせる。DB更新のたびに
+        値が変わるため、これをキャッシュキーに混ぜるだけで古い結果は
+        参照されなくなる
+        """
+        metadata_path = os.path.join(self.trivy_cache_dir, "db", "metadata.json")
+        try:
+            with open(metadata_path, 'rb') as f:
+                metadata = orjson.loads(f.read())
+            return f"{metadata.get('Version', 0)}-{int(os.path.getmtime(metadata_path))}"
+        except (OSError, orjson.JSONDecodeError):
+            return "unknown"
+
+    def _scan_cache_key(self, payload: bytes, detail: str = "full") -> str:
+        """SBOM内容のハッシュ + Trivy DB版からキャッシュキーを生成
+
+        summary結果には脆弱性リストが含まれないため、detail水準も
+        キーに混ぜてfull要求がsummaryキャッシュを拾わないようにする
+        """
+        digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+        key = f"trivy:scan:{self._trivy_db_version()}:{digest}"
+        if detail != "full":
+            key = f"{key}:{detail}"
+        return key
+
+    @staticmethod
+    def _cached_scan_result(key: str) -> Optional[Dict[str, Any]]:
+        """キャッシュされたスキャン結果を取得(Redis障害時はスキャンに進む)"""
+        try:
+            cached = redis_client.get(key)
+        except Exception as e:
+            logger.warning("Trivy scan cache read failed: %s", str(e))
+            return None
+        if cached is None:
+            return None
+        return orjson.loads(cached)
+
+    @staticmethod
+    def _store_scan_result(key: str, parsed_result: Dict[str, Any]):
+        """成功したスキャン結果だけをTTL付きでキャッシュする"""
+        if parsed_result.get("status") != "success":
+            return
+        try:
+            redis_client.setex(
+                key, SCAN_CACHE_TTL_SECONDS,
+                orjson.dumps(parsed_result).decode()
+            )
+        except Exception as e:
+            logger.warning("Trivy scan cache write failed: %s", str(e))
+
+    @staticmethod
+    def _sbom_payload(sbom_content: Optional[Dict[str, Any]],
+                      sbom_raw: Optional[bytes]) -> bytes:
+        """Trivyに渡すSBOMのバイト列を返す
+
+        sbom_rawがあればそのまま(JSON変換なしのゼロコピー経路)、
+        なければorjsonでシリアライズする(bytesを直接返すためencode不要)
+        """
+        if sbom_raw is not None:
+            return sbom_raw
+        return orjson.dumps(sbom_content, option=orjson.OPT_INDENT_2)
+
+    @staticmethod
+    def _unlink_quiet(path: str) -> None:
+        """一時ファイルを削除する
+
+        exists()+unlink()の2システムコールではなく、unlink()1回で
+        済ませて消えていた場合だけ握りつぶす(TOCTOUの窓もなくなる)
+        """
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _write_sbom_temp(payload: bytes) -> str:
+        """SBOMを一時ファイルに書き出してパスを返す"""
+        with tempfile.NamedTemporaryFile(
+            mode='wb',
+            suffix='.json',
+            delete=False
+        ) as temp_file:
+            temp_file.write(payload)
+            return temp_file.name
+
+    def _build_scan_cmd(self, temp_path: str) -> List[str]:
+        """SBOMスキャンのTrivyコマンドラインを組み立てる
+
+        --skip-db-update --offline-scanでスキャン中のDBダウンロードを
+        禁止する(レイテンシが予測可能になり、GitHubのレート制限で
+        スキャンが止まらない)。DBの鮮度はensure_db_freshが保証する
+        """
+        return [
+            self.trivy_command,
+            "sbom",
+            "--format", "json",
+            "--cache-dir", self.trivy_cache_dir,
+            "--severity", "UNKNOWN,LOW,MEDIUM,HIGH,CRITICAL",
+            "--scanners", "vuln",  # 脆弱性以外のスキャナ出力を省いてJSONを小さく
+            "--quiet",
+            "--skip-db-update",
+            "--offline-scan",
+            temp_path
+        ]
+
+    def _run_scan_streaming(self, cmd: List[str],
+                            detail: str = "full") -> Dict[str, Any]:
+        """
+        Trivyを起動し、stdoutのJSONをストリーミングでパースする
+
+        subprocess.runはstdout全体(大きなイメージSBOMでは数百MB)を
+        バッファしてからパースするが、ここではPopenのパイプから
+        ijsonでResults[*]を1ターゲットずつ読みながら集計するため、
+        メモリ使用量は1ターゲット分で頭打ちになり、Trivyの終了を
+        待たずに集計が進む。
+
+        ストリーミング読みにはsubprocess.runのような全体タイムアウトが
+        ないため、タイマーでプロセスごとkillして5分の上限を保証する。
+        stderrは別スレッドで排出する — stdoutのEOF後にまとめて読む方式
+        だと、Trivyがstderrのパイプバッファ(64KB)を埋めた時点で
+        こちらのパースと互いに待ち合ってデッドロックする
+
+        Args:
+            cmd: Trivyコマンドライン(SBOMは一時ファイルのパスで渡す)
+            detail: 'full' or 'summary'
+
+        Returns:
+            パース済みスキャン結果
+
+        Raises:
+            subprocess.TimeoutExpired: 5分以内に完了しなかった場合
+        """
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        parse_error: Optional[Exception] = None
+        parsed_result: Optional[Dict[str, Any]] = None
+
+        stderr_chunks: List[bytes] = []
+        stderr_thread = threading.Thread(
+            target=lambda: stderr_chunks.append(proc.stderr.read()),
+            daemon=True
+        )
+        stderr_thread.start()
+
+        timed_out = threading.Event()
+
+        def _kill_on_timeout():
+            timed_out.set()
+            proc.kill()
+
+        timer = threading.Timer(300, _kill_on_timeout)  # 5分タイムアウト
+        timer.start()
+        try:
+            try:
+                parsed_result = self._parse_trivy_stream(
+                    proc.stdout, detail=detail
+                )
+            except Exception as e:
+                # スキャン失敗/kill時はstdoutが空/不完全になる。
+                # 終了コードを見てから失敗として扱う
+                parse_error = e
+            returncode = proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+            # プロセス終了後はstderrがEOFになるためすぐ戻る
+            stderr_thread.join()
+            proc.stderr.close()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, 300)
+
+        stderr = b"".join(stderr_chunks)
+
+        if returncode in (0, 1) and parsed_result is not None:
+            # returncode 1 = 脆弱性が見つかった場合（正常）
+            logger.info("Trivy scan completed")
+            logger.info("Found %d vulnerabilities", parsed_result['total_vulnerabilities'])
+            return parsed_result
+
+        if returncode in (0, 1):
+            error_msg = f"Trivy scan output parse error: {str(parse_error)}"
+        else:
+            error_msg = f"Trivy scan failed: {stderr.decode(errors='replace')}"
+        logger.error(error_msg)
+        return self._failed_scan_result(error_msg)
+
+    def _parse_trivy_stream(self, stream, *,
+                            detail: str = "full") -> Dict[str, Any]:
+        """
+        TrivyのJSON出力ストリームをResults[*]単位でパースして集計
+
+        各ターゲットのdictだけをメモリに持ち、出力全体は保持しない。
+        detail='summary'なら行辞書も作らず集計値のみ計算する
+
+        Args:
+            stream: TrivyのstdoutパイプなどのバイナリIO
+            detail: 'full' or 'summary'
+
+        Returns:
+            パース済みスキャン結果(_parse_trivy_resultと同じ形)
+        """
+        vulnerabilities: List[Dict[str, Any]] = []
+        seen: Dict[tuple, Dict[str, Any]] = {}
+        total = 0
+        sev_counter: Counter = Counter()
+        components = set()
+
+        for result in ijson.items(stream, "Results.item", use_float=True):
+            vulns = result.get("Vulnerabilities") or []
+            if detail == "summary":
+                total += len(vulns)
+                sev_counter.update(
+                    v.get("Severity", "UNKNOWN") for v in vulns
+                )
+                components.update(
+                    (v.get("PkgName", "unknown"),
+                     v.get("InstalledVersion", "unknown"))
+                    for v in vulns
+                )
+            else:
+                self._extend_vuln_rows(
+                    seen, vulnerabilities,
+                    result.get("Target", "unknown"), vulns
+                )
+
+        if detail == "summary":
+            severity_counts = {
+                level: sev_counter.get(level, 0)
+                for level in ("CRITICAL", "HIGH", "MEDIUM", "LOW")
+            }
+            severity_counts["UNKNOWN"] = total - sum(severity_counts.values())
+            return {
+                "status": "success",
                 "vulnerabilities": [],
-                "severity_counts": {"CRITICAL": 0, "HIGH": 0, "MEDIUM": 0, "LOW": 0, "UNKNOWN": 0}
+                "severity_counts": severity_counts,
+                "vulnerable_components_count": len(components),
+                "total_vulnerabilities": total
             }
-    
-    def _parse_trivy_result(self, trivy_result: Dict[str, Any]) -> Dict[str, Any]:
+
+        severity_counts, vulnerable_components_count = \
+            self._aggregate_vuln_rows(vulnerabilities)
+        return {
+            "status": "success",
+            "vulnerabilities": vulnerabilities,
+            "severity_counts": severity_counts,
+            "vulnerable_components_count": vulnerable_components_count,
+            "total_vulnerabilities": len(vulnerabilities)
+        }
+
+    def _handle_scan_output(self, returncode: int,
+                            stdout: bytes, stderr: bytes,
+                            detail: str = "full") -> Dict[str, Any]:
+        """Trivyの終了コードと出力を標準のスキャン結果に変換する"""
+        if returncode == 0 or returncode == 1:
+            # returncode 1 = 脆弱性が見つかった場合（正常）
+            logger.info("Trivy scan completed")
+            parsed_result = self._parse_trivy_result(
+                orjson.loads(stdout), detail=detail
+            )
+            logger.info("Found %d vulnerabilities", parsed_result['total_vulnerabilities'])
+            return parsed_result
+
+        error_msg = f"Trivy scan failed: {stderr.decode(errors='replace')}"
+        logger.error(error_msg)
+        return self._failed_scan_result(error_msg)
+
+    @staticmethod
+    def _failed_scan_result(error_msg: str) -> Dict[str, Any]:
+        """スキャン失敗時の標準レスポンス"""
+        return {
+            "status": "failed",
+            "error": error_msg,
+            "vulnerabilities": [],
+            "severity_counts": {
+                "CRITICAL": 0,
+                "HIGH": 0,
+                "MEDIUM": 0,
+                "LOW": 0,
+                "UNKNOWN": 0
+            }
+        }
+
+    # これ以上の件数では深刻度集計と重複排除をpandasに任せる
+    # (DataFrame構築コストを回収できる規模)
+    PANDAS_PARSE_THRESHOLD = 2000
+
+    SEVERITY_LEVELS = ("CRITICAL", "HIGH", "MEDIUM", "LOW", "UNKNOWN")
+
+    @staticmethod
+    def _vuln_row(vuln: Dict[str, Any], target: str) -> Dict[str, Any]:
+        """Trivyの脆弱性1件を出力スキーマの行に変換
+
+        targetはリスト。同じ脆弱性が複数ターゲットに現れた場合は
+        行を複製せずこのリストに追記される
+        """
+        g = vuln.get
+        # CVSS情報(nvdサブ辞書の束縛は1回だけ)
+        nvd = (g("CVSS") or {}).get("nvd") or {}
+        return {
+            "cve_id": g("VulnerabilityID", "UNKNOWN"),
+            "severity": g("Severity", "UNKNOWN"),
+            "component_name": g("PkgName", "unknown"),
+            "component_version": g("InstalledVersion", "unknown"),
+            "fixed_version": g("FixedVersion", ""),
+            "title": g("Title", ""),
+            "description": g("Description", ""),
+            "cvss_score": nvd.get("V3Score", 0.0),
+            "cvss_vector": nvd.get("V3Vector", ""),
+            "references": g("References", []),
+            "target": [target],
+            "published_date": g("PublishedDate", ""),
+            "last_modified_date": g("LastModifiedDate", "")
+        }
+
+    @classmethod
+    def _extend_vuln_rows(cls, seen: Dict[tuple, Dict[str, Any]],
+                          vulnerabilities: List[Dict[str, Any]],
+                          target: str,
+                          vulns: List[Dict[str, Any]]) -> None:
+        """
+        1ターゲット分の脆弱性を行リストに追加(ターゲット横断で重複排除)
+
+        マルチステージSBOMでは同じ(cve_id, pkg, version)が複数の
+        Results[]に現れる。既出の脆弱性は行を作り直さずtargetリストに
+        追記するだけにして、レスポンスサイズと後段のシリアライズ量を
+        ターゲット数に比例して膨らませない
+
+        Args:
+            seen: (cve_id, pkg_name, installed_version) -> 既存行
+            vulnerabilities: 出力行リスト(inplaceで追記)
+            target: このResultsエントリのTarget
+            vulns: このターゲットのVulnerabilities配列
+        """
+        for vuln in vulns:
+            g = vuln.get
+            key = (
+                g("VulnerabilityID", "UNKNOWN"),
+                g("PkgName", "unknown"),
+                g("InstalledVersion", "unknown")
+            )
+            row = seen.get(key)
+            if row is not None:
+                if target not in row["target"]:
+                    row["target"].append(target)
+                continue
+            row = cls._vuln_row(vuln, target)
+            seen[key] = row
+            vulnerabilities.append(row)
+
+    def _parse_trivy_result(self, trivy_result: Dict[str, Any], *,
+                            detail: str = "full") -> Dict[str, Any]:
         """
         Trivyのスキャン結果をパースして標準フォーマットに変換
-        
+
+        行の変換は1本の内包表記で行い、深刻度集計と脆弱コンポーネントの
+        重複排除は件数が多い場合にpandasのC実装
+        (value_counts / drop_duplicates)へ委譲する
+
         Args:
             trivy_result: Trivyの生JSON結果
-            
+            detail: 'summary'の場合は行変換を丸ごと省き、集計値だけを
+                Trivyの生構造から直接計算する(vulnerabilitiesは空リスト)
+
         Returns:
             パース済みスキャン結果
         """
-        vulnerabilities = []
-        severity_counts = {
-            "CRITICAL": 0,
-            "HIGH": 0,
-            "MEDIUM": 0,
-            "LOW": 0,
-            "UNKNOWN": 0
-        }
-        
-        vulnerable_components = set()
-        
-        # Trivyの結果構造を解析
-        results = trivy_result.get("Results", [])
-        
-        for result in results:
-            target = result.get("Target", "unknown")
-            vulns = result.get("Vulnerabilities", [])
-            
-            for vuln in vulns:
-                cve_id = vuln.get("VulnerabilityID", "UNKNOWN")
-                severity = vuln.get("Severity", "UNKNOWN")
-                pkg_name = vuln.get("PkgName", "unknown")
-                installed_version = vuln.get("InstalledVersion", "unknown")
-                fixed_version = vuln.get("FixedVersion", "")
-                title = vuln.get("Title", "")
-                description = vuln.get("Description", "")
-                
-                # CVSS情報
-                cvss_v3 = vuln.get("CVSS", {}).get("nvd", {}).get("V3Score", 0.0)
-                cvss_vector = vuln.get("CVSS", {}).get("nvd", {}).get("V3Vector", "")
-                
-                # 参照情報
-                references = vuln.get("References", [])
-                
-                vulnerability_data = {
-                    "cve_id": cve_id,
-                    "severity": severity,
-                    "component_name": pkg_name,
-                    "component_version": installed_version,
-                    "fixed_version": fixed_version,
-                    "title": title,
-                    "description": description,
-                    "cvss_score": cvss_v3,
-                    "cvss_vector": cvss_vector,
-                    "references": references,
-                    "target": target,
-                    "published_date": vuln.get("PublishedDate", ""),
-                    "last_modified_date": vuln.get("LastModifiedDate", "")
-                }
-                
-                vulnerabilities.append(vulnerability_data)
-                
-                # 統計情報を更新
-                if severity in severity_counts:
-                    severity_counts[severity] += 1
-                else:
-                    severity_counts["UNKNOWN"] += 1
-                
-                # 脆弱なコンポーネントを記録
-                vulnerable_components.add(f"{pkg_name}@{installed_version}")
-        
+        if detail == "summary":
+            return self._summarize_trivy_result(trivy_result)
+
+        # Results[*].Vulnerabilities[*]をフラットな行リストに変換
+        # (同一脆弱性はターゲット横断で1行にまとめる)
+        vulnerabilities = list(self._iter_trivy_vulns(trivy_result))
+
+        severity_counts, vulnerable_components_count = \
+            self._aggregate_vuln_rows(vulnerabilities)
+
         return {
             "status": "success",
             "vulnerabilities": vulnerabilities,
             "severity_counts": severity_counts,
-            "vulnerable_components_count": len(vulnerable_components),
+            "vulnerable_components_count": vulnerable_components_count,
             "total_vulnerabilities": len(vulnerabilities)
         }
+
+    def _iter_trivy_vulns(self, trivy_result: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Trivyの生JSON結果から脆弱性行を1件ずつyieldする
+
+        リスト全体を先に組み立てないため、NDJSONのStreamingResponse等
+        パース済み行をそのまま流したい呼び出し側で使える。重複排除は
+        _parse_trivy_resultと同じで、2つ目以降のターゲットで見つかった
+        既出の脆弱性はyield済みの行のtargetリストに追記される
+        (行を全部持つ呼び出し側には反映され、流し捨てる側では落ちる)
+
+        Args:
+            trivy_result: Trivyの生JSON結果
+
+        Yields:
+            _vuln_row形式の脆弱性行
+        """
+        seen: Dict[tuple, Dict[str, Any]] = {}
+        for result in trivy_result.get("Results", []):
+            fresh: List[Dict[str, Any]] = []
+            self._extend_vuln_rows(
+                seen, fresh,
+                result.get("Target", "unknown"),
+                result.get("Vulnerabilities", [])
+            )
+            yield from fresh
+
+    def _aggregate_vuln_rows(self, vulnerabilities: List[Dict[str, Any]]):
+        """
+        変換済みの脆弱性行から深刻度集計と脆弱コンポーネント数を計算
+
+        Returns:
+            (severity_counts, vulnerable_components_count)のタプル
+        """
+        if len(vulnerabilities) >= self.PANDAS_PARSE_THRESHOLD:
+            df = pd.DataFrame(
+                vulnerabilities,
+                columns=["severity", "component_name", "component_version"]
+            )
+            severities = df["severity"].where(
+                df["severity"].isin(self.SEVERITY_LEVELS), "UNKNOWN"
+            )
+            counts = severities.value_counts().reindex(
+                self.SEVERITY_LEVELS, fill_value=0
+            )
+            severity_counts = {
+                level: int(count) for level, count in counts.items()
+            }
+            vulnerable_components_count = int(
+                df[["component_name", "component_version"]]
+                .drop_duplicates().shape[0]
+            )
+        else:
+            # ループ内の分岐なしでCounterに集計し、
+            # 未知の深刻度はループ後にまとめてUNKNOWNへ寄せる
+            sev_counter = Counter(row["severity"] for row in vulnerabilities)
+            severity_counts = {
+                level: sev_counter.get(level, 0)
+                for level in ("CRITICAL", "HIGH", "MEDIUM", "LOW")
+            }
+            severity_counts["UNKNOWN"] = (
+                len(vulnerabilities) - sum(severity_counts.values())
+            )
+            vulnerable_components_count = len({
+                (row["component_name"], row["component_version"])
+                for row in vulnerabilities
+            })
+
+        return severity_counts, vulnerable_components_count
+
+    def _summarize_trivy_result(self, trivy_result: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Trivyの生JSONから集計値だけを計算する(detail='summary'用)
+
+        _vuln_rowの行辞書を1件も作らず、深刻度と脆弱コンポーネントを
+        生構造から直接集計する
+        """
+        total = 0
+        sev_counter: Counter = Counter()
+        components = set()
+        for result in trivy_result.get("Results", []):
+            vulns = result.get("Vulnerabilities", [])
+            total += len(vulns)
+            sev_counter.update(v.get("Severity", "UNKNOWN") for v in vulns)
+            components.update(
+                (v.get("PkgName", "unknown"), v.get("InstalledVersion", "unknown"))
+                for v in vulns
+            )
+
+        severity_counts = {
+            level: sev_counter.get(level, 0)
+            for level in ("CRITICAL", "HIGH", "MEDIUM", "LOW")
+        }
+        severity_counts["UNKNOWN"] = total - sum(severity_counts.values())
+
+        return {
+            "status": "success",
+            "vulnerabilities": [],
+            "severity_counts": severity_counts,
+            "vulnerable_components_count": len(components),
+            "total_vulnerabilities": total
+        }
     
+    # ローカルDBをこの秒数より古いまま使わない(スキャンは
+    # --skip-db-updateで走るため、鮮度の維持はこちらの責務)
+    DB_MAX_AGE_SECONDS = 86400
+
+    def ensure_db_fresh(self) -> Dict[str, Any]:
+        """
+        TrivyローカルDBが存在し24時間以内であることを保証する
+
+        DBが未取得または古い場合のみupdate_database()を実行する。
+        アプリ起動時に1回呼ぶ想定
+
+        Returns:
+            更新を実行した場合はその結果、スキップした場合はstatus='skipped'
+        """
+        age = self.get_db_age_seconds()
+        if age is not None and age <= self.DB_MAX_AGE_SECONDS:
+            logger.info("Trivy DB is fresh (%ds old), skipping update", int(age))
+            return {"status": "skipped", "db_age_seconds": age}
+        return self.update_database()
+
+    def get_db_age_seconds(self) -> Optional[float]:
+        """
+        TrivyローカルDBの経過秒数を取得
+
+        Returns:
+            metadata.jsonのmtimeからの経過秒数、DBが未取得の場合None
+        """
+        metadata_path = os.path.join(self.trivy_cache_dir, "db", "metadata.json")
+        try:
+            return time.time() - os.path.getmtime(metadata_path)
+        except OSError:
+            return None
+
     def check_trivy_installed(self) -> bool:
         """
         Trivyがインストールされているか確認
-        
+
+        結果はプロセス内で変わらないため初回の1回だけサブプロセスを
+        起動し、以降はメモした値を返す(ヘルスチェック等が毎回呼んでも
+        20-50msのspawnコストを払わない)。再判定が必要なら
+        reset_installed_check()を呼ぶ
+
         Returns:
             インストールされている場合True
         """
+        if self._installed is not None:
+            return self._installed
+        self._installed = self._probe_trivy_installed()
+        return self._installed
+
+    def reset_installed_check(self) -> None:
+        """check_trivy_installed()のメモを破棄して次回に再判定させる"""
+        self._installed = None
+
+    def _probe_trivy_installed(self) -> bool:
+        """trivy --versionを実際に実行してインストール状態を判定"""
         try:
             result = subprocess.run(
                 [self.trivy_command, "--version"],
@@ -271,11 +954,11 @@ class TrivyService:
                 timeout=5
             )
             if result.returncode == 0:
-                logger.info(f"Trivy is installed: {result.stdout.strip()}")
+                logger.info("Trivy is installed: %s", result.stdout.strip())
                 return True
             return False
         except Exception as e:
-            logger.error(f"Trivy check failed: {str(e)}")
+            logger.error("Trivy check failed: %s", str(e))
             return False
 
 
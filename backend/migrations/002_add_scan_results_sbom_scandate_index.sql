@@ -0,0 +1,8 @@
+-- Migration: Add composite index (sbom_id, scan_date DESC) on scan_results
+-- Date: 2026-08-29
+--
+-- 最新スキャン取得 (WHERE sbom_id = ? ORDER BY scan_date DESC LIMIT 1) を
+-- ソートなしの1回のインデックス探索で解決できるようにする
+
+CREATE INDEX IF NOT EXISTS ix_scan_results_sbom_scandate
+    ON scan_results (sbom_id, scan_date DESC);
@@ -0,0 +1,16 @@
+-- Migration: Add denormalized component_count to sboms
+-- Date: 2026-08-29
+--
+-- 一覧表示や重複チェックのたびにJSONB content_jsonを
+-- デシリアライズしてコンポーネント数を数え直さないようにする
+
+ALTER TABLE sboms ADD COLUMN IF NOT EXISTS component_count INTEGER DEFAULT 0;
+
+-- 既存行をcontent_jsonからバックフィル
+UPDATE sboms
+SET component_count = COALESCE(
+    jsonb_array_length(content_json->'components'),
+    jsonb_array_length(content_json->'packages'),
+    0
+)
+WHERE component_count IS NULL OR component_count = 0;
@@ -0,0 +1,24 @@
+-- Migration: Add ON DELETE CASCADE foreign keys for scan tables
+-- Date: 2026-08-29
+--
+-- SBOM削除時に関連するscan_results / scan_vulnerabilitiesを
+-- DBレベルのCASCADEで一括削除できるようにする
+
+BEGIN;
+
+-- 孤児行があるとFK追加に失敗するため先に掃除する
+DELETE FROM scan_vulnerabilities sv
+WHERE NOT EXISTS (SELECT 1 FROM scan_results sr WHERE sr.id = sv.scan_result_id);
+
+DELETE FROM scan_results sr
+WHERE NOT EXISTS (SELECT 1 FROM sboms s WHERE s.id = sr.sbom_id);
+
+ALTER TABLE scan_results
+    ADD CONSTRAINT fk_scan_results_sbom_id
+    FOREIGN KEY (sbom_id) REFERENCES sboms(id) ON DELETE CASCADE;
+
+ALTER TABLE scan_vulnerabilities
+    ADD CONSTRAINT fk_scan_vulnerabilities_scan_result_id
+    FOREIGN KEY (scan_result_id) REFERENCES scan_results(id) ON DELETE CASCADE;
+
+COMMIT;
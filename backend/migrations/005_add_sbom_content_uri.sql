@@ -0,0 +1,7 @@
+-- Migration: Add content_uri to sboms
+-- Date: 2026-08-29
+--
+-- アップロード原本をuploadsボリュームにfile_hashキーで保存し、
+-- スキャン時にJSONB(TOAST)の取り出しを回避できるようにする
+
+ALTER TABLE sboms ADD COLUMN IF NOT EXISTS content_uri VARCHAR(512);
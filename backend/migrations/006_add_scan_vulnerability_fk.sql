@@ -0,0 +1,16 @@
+-- Migration: Add foreign key from scan_vulnerabilities to vulnerabilities
+-- Date: 2026-08-29
+--
+-- ORMのリレーション(selectinload/joinedload)が使えるようにFKを宣言する
+
+BEGIN;
+
+-- 孤児行があるとFK追加に失敗するため先に掃除する
+DELETE FROM scan_vulnerabilities sv
+WHERE NOT EXISTS (SELECT 1 FROM vulnerabilities v WHERE v.id = sv.vulnerability_id);
+
+ALTER TABLE scan_vulnerabilities
+    ADD CONSTRAINT fk_scan_vulnerabilities_vulnerability_id
+    FOREIGN KEY (vulnerability_id) REFERENCES vulnerabilities(id);
+
+COMMIT;
@@ -0,0 +1,14 @@
+-- Migration: Add covering index for scan vulnerability detail reads
+-- Date: 2026-08-29
+--
+-- WHERE scan_result_id = ? の詳細取得がヒープ参照なしの
+-- インデックスオンリースキャンになるよう、結合キーと表示カラムを
+-- INCLUDEに含める
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS ix_scan_vulnerabilities_scan_result_covering
+    ON scan_vulnerabilities (scan_result_id)
+    INCLUDE (vulnerability_id, component_name, component_version);
+
+COMMIT;
@@ -0,0 +1,35 @@
+-- Migration: Add denormalized vulnerability_products table
+-- Date: 2026-08-29
+--
+-- cpe_matchのcriteriaに含まれる(製品名, ベンダー名)を行持ちに展開し、
+-- スキャン時の候補絞り込みをインデックス付きSQLで行えるようにする
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS vulnerability_products (
+    id SERIAL PRIMARY KEY,
+    vulnerability_id INTEGER NOT NULL
+        REFERENCES vulnerabilities(id) ON DELETE CASCADE,
+    product VARCHAR(255) NOT NULL,
+    vendor VARCHAR(255)
+);
+
+CREATE INDEX IF NOT EXISTS ix_vulnerability_products_vulnerability_id
+    ON vulnerability_products (vulnerability_id);
+CREATE INDEX IF NOT EXISTS ix_vulnerability_products_product
+    ON vulnerability_products (product);
+
+-- 既存のcpe_matchからバックフィル
+-- criteria形式: cpe:2.3:a:vendor:product:version:...
+INSERT INTO vulnerability_products (vulnerability_id, product, vendor)
+SELECT DISTINCT
+    v.id,
+    lower(split_part(m->>'criteria', ':', 5)),
+    lower(split_part(m->>'criteria', ':', 4))
+FROM vulnerabilities v,
+     jsonb_array_elements(v.cpe_match) AS m
+WHERE v.cpe_match IS NOT NULL
+  AND jsonb_typeof(v.cpe_match) = 'array'
+  AND split_part(m->>'criteria', ':', 5) <> '';
+
+COMMIT;
@@ -0,0 +1,25 @@
+-- Migration: Backfill pre-parsed CPE fields into cpe_match JSONB
+-- Date: 2026-08-29
+--
+-- 取り込み時にcriteriaを分解したvendor/product/versionを各エントリに
+-- 持たせるようになったため、既存行にも同じフィールドを埋め込む
+-- (スキャン時の再分解を不要にする)
+
+BEGIN;
+
+UPDATE vulnerabilities v
+SET cpe_match = (
+    SELECT jsonb_agg(
+        m || jsonb_build_object(
+            'vendor', lower(split_part(m->>'criteria', ':', 4)),
+            'product', lower(split_part(m->>'criteria', ':', 5)),
+            'version', lower(split_part(m->>'criteria', ':', 6))
+        )
+    )
+    FROM jsonb_array_elements(v.cpe_match) AS m
+)
+WHERE v.cpe_match IS NOT NULL
+  AND jsonb_typeof(v.cpe_match) = 'array'
+  AND jsonb_array_length(v.cpe_match) > 0;
+
+COMMIT;